@@ -0,0 +1,109 @@
+"""Benchmarks a typical zse run through the latency proxy, so the cost of
+each round trip shows up the way it does from a home network.
+
+    python benchmarks/bench_latency.py [--rtt 30,100,300] [--jitter MS]
+                                       [--bandwidth MBIT] [--files N]
+
+For every RTT it times connecting, the remote setup exec, the SFTP upload
+of a small lab-sized tree and running a command, with the requests counted
+by the stand-in server
+"""
+
+import argparse
+import os
+import tempfile
+
+from bench_sync import build_tree, measure, print_results, result, zse, zse_args
+from latency_proxy import LatencyProxy
+from standin import StandInServer
+
+
+def bench_link(server, rtt, opts, local):
+    """Runs each phase of a zse run through a proxy with the given RTT"""
+    results = []
+    case = f"{rtt:g} ms"
+    sizes = [
+        os.path.getsize(os.path.join(local, "src", name))
+        for name in os.listdir(os.path.join(local, "src"))
+    ]
+
+    def bench(benchmark, run, prepare=lambda: None, files=0, size=0):
+        """Measures run and records it as one row of results"""
+        seconds, requests = measure(run, prepare, server, opts.repeat)
+        results.append(result(benchmark, case, files, size, seconds, requests))
+
+    with LatencyProxy(server.address, rtt, opts.jitter, opts.bandwidth) as proxy:
+        bench("connect", lambda: server.connect(proxy.address).close())
+
+        client = server.connect(proxy.address)
+        args = zse_args(opts.jobs)
+        sftp = client.open_sftp()
+        try:
+            remote = ".zse/bench"
+            bench("setup", lambda: zse.prepare_remote(client, remote, args))
+
+            def clear_remote():
+                client.exec_command(f"rm -rf {remote}/*")[1].read()
+
+            bench(
+                "upload",
+                lambda: zse.sftp_recursive_put(sftp, local, remote, args, client),
+                clear_remote,
+                len(sizes),
+                sum(sizes),
+            )
+
+            def run_command():
+                command = zse.remote_command(remote, "ls src | wc -l", cleanup=False)
+                _stdin, stdout, stderr = client.exec_command(command, get_pty=True)
+                zse.read_terminal(stdout, stderr)
+
+            bench("command", run_command)
+        finally:
+            sftp.close()
+            client.close()
+    return results
+
+
+def parse_args():
+    """Reads the benchmark options"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--rtt",
+        default="30,100,300",
+        help="Comma separated round-trip times in ms (default: 30,100,300)",
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Random +/- ms added per chunk"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, help="Link speed cap in Mbit/s (default: none)"
+    )
+    parser.add_argument(
+        "--files", type=int, default=20, help="Files in the uploaded tree"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=zse.DEFAULT_JOBS, help="zse --jobs value"
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3, help="Runs per case, median is kept"
+    )
+    return parser.parse_args()
+
+
+def main():
+    """Runs every phase for every RTT against a fresh stand-in server"""
+    opts = parse_args()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="zse-standin-") as root:
+        with tempfile.TemporaryDirectory(prefix="zse-bench-") as local:
+            shape = [(f"src/file{i:03}.c", 2048) for i in range(opts.files)]
+            build_tree(local, shape, 1.0)
+            with StandInServer(root) as server:
+                for rtt in opts.rtt.split(","):
+                    results += bench_link(server, float(rtt), opts, local)
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Checks that the paths which never touch the network start quickly.
+
+    python benchmarks/bench_startup.py [--budget MS] [--runs N]
+
+Runs `zse --version`, `zse --help` and a first run that creates the config
+file in fresh processes, and exits non-zero if the fastest run of any of
+them is over budget or if importing main pulled in paramiko
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+MAIN = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py"
+)
+HEAVY_MODULES = ["paramiko", "cryptography", "colorama", "platformdirs"]
+
+
+def time_run(argv, env):
+    """Returns the wall time in ms of running main.py with argv"""
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, MAIN, *argv],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+def config_creation_env(home):
+    """Environment whose config dir under home is empty, so zse writes a
+    fresh config"""
+    return dict(
+        os.environ,
+        HOME=home,
+        XDG_CONFIG_HOME=os.path.join(home, ".config"),
+        APPDATA=home,
+        LOCALAPPDATA=home,
+    )
+
+
+def heavy_imports():
+    """Lists the heavy modules that `import main` loads on its own"""
+    check = (
+        f"import sys; sys.path.insert(0, {os.path.dirname(MAIN)!r}); import main; "
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", check], capture_output=True, text=True, check=True
+    )
+    return output.stdout.split()
+
+
+def main():
+    """Times each startup path against the budget"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--budget", type=float, default=100, help="Allowed ms per run (default: 100)"
+    )
+    parser.add_argument(
+        "--runs", type=int, default=5, help="Runs per path, fastest is kept"
+    )
+    opts = parser.parse_args()
+
+    cases = [
+        ("--version", ["--version"], False),
+        ("--help", ["--help"], False),
+        ("config creation", ["true"], True),
+    ]
+    failed = False
+    print(f"{'path':<16} {'ms':>8}  budget {opts.budget:g} ms")
+    for name, argv, fresh_config in cases:
+        runs = []
+        for _ in range(opts.runs):
+            if not fresh_config:
+                runs.append(time_run(argv, dict(os.environ)))
+                continue
+            # every config creation run needs its own empty config dir
+            with tempfile.TemporaryDirectory(prefix="zse-startup-") as home:
+                runs.append(time_run(argv, config_creation_env(home)))
+        elapsed = min(runs)
+        over = elapsed > opts.budget
+        failed |= over
+        print(f"{name:<16} {elapsed:>8.1f}  {'OVER' if over else 'ok'}")
+
+    heavy = heavy_imports()
+    if heavy:
+        failed = True
+        print(f"import main loaded: {', '.join(heavy)}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
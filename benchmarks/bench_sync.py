@@ -0,0 +1,217 @@
+"""Benchmarks zse's upload, download and output paths against the in-process
+stand-in server, so sync-engine changes can be measured without a CSE login.
+
+    python benchmarks/bench_sync.py [--jobs N] [--repeat N] [--json FILE]
+
+Reports files/s, MB/s and the number of SFTP/exec requests per run
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from standin import StandInServer  # pylint: disable=wrong-import-position
+import main as zse  # pylint: disable=wrong-import-position
+
+MIB = 1024 * 1024
+
+# name -> list of (relative path, size in bytes)
+TREE_SHAPES = {
+    "1 big file": [("big.bin", 64 * MIB)],
+    "1000 tiny files": [(f"src/file{i:04}.c", 512) for i in range(1000)],
+    "deep nesting": [
+        ("/".join(f"d{level}" for level in range(depth + 1)) + f"/f{i}.txt", 4096)
+        for depth in range(40)
+        for i in range(3)
+    ],
+}
+OUTPUT_VOLUMES = [1 * MIB, 16 * MIB, 64 * MIB]
+
+
+def build_tree(root, shape, scale):
+    """Writes the files of shape under root, sizes multiplied by scale"""
+    for relpath, size in shape:
+        path = os.path.join(root, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(os.urandom(max(1, int(size * scale))))
+
+
+def tree_size(root):
+    """Returns (file count, total bytes) of the tree under root"""
+    files = size = 0
+    for dirpath, _dirs, names in os.walk(root):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return files, size
+
+
+def zse_args(jobs):
+    """Parses a zse command line the way the CLI would, with prompts off"""
+    argv = sys.argv
+    sys.argv = ["zse", "-f", "-j", str(jobs), "true"]
+    try:
+        return zse.setup_argparse()
+    finally:
+        sys.argv = argv
+
+
+def measure(run, prepare, server, repeat):
+    """Runs prepare then run repeat times, returning the median seconds and
+    the requests of the last run"""
+    durations = []
+    for _ in range(repeat):
+        prepare()
+        server.counter.reset()
+        with open(os.devnull, "w", encoding="utf-8") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                run()
+                durations.append(time.perf_counter() - start)
+    return statistics.median(durations), server.counter.total
+
+
+def bench_upload(client, server, local, shape_name, opts):
+    """Times sftp_recursive_put of local into a fresh remote directory"""
+    remote = "upload"
+    remote_root = os.path.join(server.root, remote)
+    sftp = client.open_sftp()
+    args = zse_args(opts.jobs)
+    try:
+        seconds, requests = measure(
+            lambda: zse.sftp_recursive_put(sftp, local, remote, args, client),
+            lambda: shutil.rmtree(remote_root, ignore_errors=True),
+            server,
+            opts.repeat,
+        )
+    finally:
+        sftp.close()
+    return result("upload", shape_name, *tree_size(local), seconds, requests)
+
+
+def bench_download(client, server, local, shape_name, opts, workdir):
+    """Times download_dir of a remote copy of local into an empty directory"""
+    remote = "download"
+    shutil.rmtree(os.path.join(server.root, remote), ignore_errors=True)
+    shutil.copytree(local, os.path.join(server.root, remote))
+    target = os.path.join(workdir, "downloaded")
+    sftp = client.open_sftp()
+    args = zse_args(opts.jobs)
+    try:
+        seconds, requests = measure(
+            lambda: zse.download_dir(sftp, remote, target, args, client),
+            lambda: shutil.rmtree(target, ignore_errors=True),
+            server,
+            opts.repeat,
+        )
+    finally:
+        sftp.close()
+    return result("download", shape_name, *tree_size(local), seconds, requests)
+
+
+def bench_output(client, server, volume, opts):
+    """Times read_terminal draining volume bytes of command output"""
+    command = f"yes 'zse benchmark output line' | head -c {volume}"
+
+    def run():
+        _stdin, stdout, stderr = client.exec_command(command, get_pty=True)
+        zse.read_terminal(stdout, stderr)
+
+    seconds, requests = measure(run, lambda: None, server, opts.repeat)
+    return result("output", zse.format_size(volume), 0, volume, seconds, requests)
+
+
+def result(benchmark, case, files, size, seconds, requests):
+    """Bundles one measurement with its derived rates"""
+    return {
+        "benchmark": benchmark,
+        "case": case,
+        "files": files,
+        "bytes": size,
+        "seconds": round(seconds, 4),
+        "files_per_s": round(files / seconds, 1) if seconds else 0,
+        "mb_per_s": round(size / MIB / seconds, 2) if seconds else 0,
+        "requests": requests,
+    }
+
+
+def run_suite(server, opts, address=None):
+    """Runs every benchmark against server, connecting through address when
+    given, and returns the results"""
+    results = []
+    client = server.connect(address)
+    try:
+        with tempfile.TemporaryDirectory(prefix="zse-bench-") as workdir:
+            for shape_name, shape in TREE_SHAPES.items():
+                local = os.path.join(workdir, "tree")
+                shutil.rmtree(local, ignore_errors=True)
+                build_tree(local, shape, opts.scale)
+                results.append(bench_upload(client, server, local, shape_name, opts))
+                results.append(
+                    bench_download(client, server, local, shape_name, opts, workdir)
+                )
+            for volume in OUTPUT_VOLUMES:
+                results.append(
+                    bench_output(client, server, int(volume * opts.scale), opts)
+                )
+    finally:
+        client.close()
+    return results
+
+
+def print_results(results):
+    """Prints results as an aligned table"""
+    header = f"{'benchmark':<10} {'case':<16} {'files':>6} {'seconds':>9} "
+    header += f"{'files/s':>9} {'MB/s':>8} {'requests':>9}"
+    print(header)
+    print("-" * len(header))
+    for row in results:
+        print(
+            f"{row['benchmark']:<10} {row['case']:<16} {row['files']:>6} "
+            f"{row['seconds']:>9.3f} {row['files_per_s']:>9} "
+            f"{row['mb_per_s']:>8} {row['requests']:>9}"
+        )
+
+
+def parse_args(parser=None):
+    """Reads the benchmark options"""
+    parser = parser or argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=zse.DEFAULT_JOBS, help="zse --jobs value"
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=3, help="Runs per case, median is kept"
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiplies every file size and output volume",
+    )
+    parser.add_argument("--json", metavar="FILE", help="Also writes results to FILE")
+    return parser.parse_args()
+
+
+def main():
+    """Runs the suite against a fresh stand-in server"""
+    opts = parse_args()
+    with tempfile.TemporaryDirectory(prefix="zse-standin-") as root:
+        with StandInServer(root) as server:
+            results = run_suite(server, opts)
+    print_results(results)
+    if opts.json:
+        with open(opts.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Local TCP proxy that adds round-trip time, jitter and a bandwidth cap
+between zse and the stand-in server, so localhost benchmarks pay the same
+per-request costs as a home connection to CSE
+"""
+
+import queue
+import random
+import socket
+import threading
+import time
+
+from localserver import LocalServer
+
+CHUNK_SIZE = 64 * 1024
+
+
+class LatencyProxy(LocalServer):
+    """Forwards connections on a local port to target, delaying every chunk
+    by half the RTT (plus jitter) in each direction and pacing it to the
+    bandwidth cap. Chunks keep their order, like bytes on a TCP link"""
+
+    def __init__(self, target, rtt_ms=0.0, jitter_ms=0.0, bandwidth_mbit=None):
+        super().__init__()
+        self.target = target
+        self.delay = rtt_ms / 2000
+        self.jitter = jitter_ms / 1000
+        self.byte_time = 8 / (bandwidth_mbit * 1e6) if bandwidth_mbit else 0
+
+    def handle(self, conn):
+        """Pairs an accepted connection with one to the target"""
+        upstream = socket.create_connection(self.target)
+        for sock in (conn, upstream):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections += [conn, upstream]
+        self.link(conn, upstream)
+        self.link(upstream, conn)
+
+    def link(self, source, dest):
+        """Starts relaying one direction of a connection"""
+        pending = queue.Queue()
+        threading.Thread(
+            target=self.read_side, args=(source, pending), daemon=True
+        ).start()
+        threading.Thread(
+            target=self.write_side, args=(dest, pending), daemon=True
+        ).start()
+
+    def read_side(self, source, pending):
+        """Stamps each chunk read from source with the time it may arrive"""
+        last_release = 0.0
+        while True:
+            try:
+                data = source.recv(CHUNK_SIZE)
+            except OSError:
+                data = b""
+            jitter = random.uniform(-self.jitter, self.jitter) if self.jitter else 0
+            # never release before an earlier chunk, TCP does not reorder
+            last_release = max(last_release, time.monotonic() + self.delay + jitter)
+            pending.put((last_release, data))
+            if not data:
+                return
+
+    def write_side(self, dest, pending):
+        """Sends chunks once they are due, no faster than the bandwidth cap"""
+        link_free = 0.0
+        while True:
+            release, data = pending.get()
+            if not data:
+                break
+            # the chunk finishes arriving once the link has carried all of it
+            link_free = max(link_free, release) + len(data) * self.byte_time
+            wait = link_free - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                dest.sendall(data)
+            except OSError:
+                break
+        try:
+            dest.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
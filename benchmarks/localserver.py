@@ -0,0 +1,50 @@
+"""Accept loop shared by the stand-in server and the latency proxy"""
+
+import socket
+import threading
+
+
+class LocalServer:
+    """Listens on a free localhost port and passes every accepted connection
+    to handle() from a background thread. stop() also closes whatever
+    handle() added to self.connections"""
+
+    def __init__(self):
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.connections = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        """(host, port) clients should connect to"""
+        return self.listener.getsockname()[:2]
+
+    def start(self):
+        """Starts accepting connections in the background"""
+        self.thread.start()
+        return self
+
+    def serve_forever(self):
+        """Accepts connections until the listener is closed"""
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            self.handle(conn)
+
+    def handle(self, conn):
+        """Serves one accepted connection"""
+        raise NotImplementedError
+
+    def stop(self):
+        """Stops listening and closes every connection handed out"""
+        self.listener.close()
+        for connection in self.connections:
+            connection.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
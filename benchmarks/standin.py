@@ -0,0 +1,271 @@
+"""In-process SSH/SFTP server that stands in for the CSE login servers
+so zse can be benchmarked offline. Every file operation is served from a
+local root directory and every SFTP request and exec request is counted.
+Pipelined requests (like the writes of one upload) each count, so the
+count is the number of requests, not of round trips waited on
+"""
+
+import os
+import subprocess
+import threading
+
+import paramiko
+from paramiko import (
+    AUTH_FAILED,
+    AUTH_SUCCESSFUL,
+    OPEN_SUCCEEDED,
+    SFTP_OK,
+    SFTPAttributes,
+    SFTPHandle,
+    SFTPServer,
+    SFTPServerInterface,
+    ServerInterface,
+)
+
+from localserver import LocalServer
+
+USERNAME = "z5555555"
+PASSWORD = "bench"
+
+
+class RequestCounter:
+    """Thread-safe count of the SFTP and exec requests the server answered"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sftp = 0
+        self.exec = 0
+
+    def add(self, kind):
+        """Counts one request of kind ("sftp" or "exec")"""
+        with self.lock:
+            setattr(self, kind, getattr(self, kind) + 1)
+
+    def reset(self):
+        """Zeroes the counters between benchmark runs"""
+        with self.lock:
+            self.sftp = 0
+            self.exec = 0
+
+    @property
+    def total(self):
+        """All requests seen since the last reset"""
+        return self.sftp + self.exec
+
+
+class CountingSFTPServer(SFTPServer):
+    """SFTP subsystem that counts each request it answers"""
+
+    def __init__(self, channel, name, server, *args, **kwargs):
+        self.counter = server.counter
+        super().__init__(channel, name, server, *args, **kwargs)
+
+    def _process(self, t, request_number, msg):
+        self.counter.add("sftp")
+        super()._process(t, request_number, msg)
+
+
+class StandInHandle(SFTPHandle):
+    """Open file on the stand-in server"""
+
+    def __init__(self, flags, file):
+        super().__init__(flags)
+        self.readfile = self.writefile = file
+
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+class StandInSFTP(SFTPServerInterface):
+    """Maps SFTP paths onto the stand-in root directory"""
+
+    def __init__(self, server, *args, **kwargs):
+        self.root = server.root
+        super().__init__(server, *args, **kwargs)
+
+    def local(self, path):
+        """Resolves a remote path, relative paths start at the home dir"""
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def list_folder(self, path):
+        path = self.local(path)
+        try:
+            items = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                items.append(attr)
+            return items
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self.local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self.local(path), flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        return StandInHandle(flags, os.fdopen(fd, mode))
+
+    def remove(self, path):
+        try:
+            os.remove(self.local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self.local(oldpath), self.local(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self.local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        return SFTP_OK
+
+    def canonicalize(self, path):
+        return "/" + path.lstrip("/")
+
+
+class StandInInterface(ServerInterface):
+    """Accepts the benchmark user and runs exec requests with /bin/sh"""
+
+    def __init__(self, root, counter):
+        self.root = root
+        self.counter = counter
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        if username == USERNAME and password == PASSWORD:
+            return AUTH_SUCCESSFUL
+        return AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *_args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        self.counter.add("exec")
+        threading.Thread(
+            target=run_command,
+            args=(channel, command.decode(), self.root),
+            daemon=True,
+        ).start()
+        return True
+
+
+def run_command(channel, command, root):
+    """Runs command in root, relaying its output and exit status"""
+    env = dict(os.environ, HOME=root)
+    with subprocess.Popen(
+        ["/bin/sh", "-c", command],
+        cwd=root,
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    ) as proc:
+
+        def pump_stdin():
+            while True:
+                data = channel.recv(64 * 1024)
+                if not data:
+                    break
+                try:
+                    proc.stdin.write(data)
+                    proc.stdin.flush()  # interactive input must not wait for EOF
+                except OSError:
+                    break
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+        def pump_stderr():
+            for data in iter(lambda: proc.stderr.read1(64 * 1024), b""):
+                channel.sendall_stderr(data)
+
+        threading.Thread(target=pump_stdin, daemon=True).start()
+        stderr = threading.Thread(target=pump_stderr, daemon=True)
+        stderr.start()
+        for data in iter(lambda: proc.stdout.read1(64 * 1024), b""):
+            channel.sendall(data)
+        stderr.join()
+        channel.send_exit_status(proc.wait())
+    channel.close()
+
+
+class StandInServer(LocalServer):
+    """Listens on localhost and serves SSH/SFTP out of root"""
+
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+        self.counter = RequestCounter()
+        self.host_key = paramiko.RSAKey.generate(2048)
+
+    def handle(self, conn):
+        """Hands an accepted connection to its own paramiko transport"""
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", CountingSFTPServer, StandInSFTP)
+        transport.start_server(server=StandInInterface(self.root, self.counter))
+        self.connections.append(transport)
+
+    def connect(self, address=None):
+        """Returns an SSHClient logged in to the server, or to address when
+        the connection should go through something like a proxy"""
+        host, port = address or self.address
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            host,
+            port=port,
+            username=USERNAME,
+            password=PASSWORD,
+            look_for_keys=False,
+            allow_agent=False,
+        )
+        return client
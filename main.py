@@ -3,30 +3,175 @@ Useful for autotests and lab submissions
 """
 
 import os
-import secrets
 import sys
+import json
+import struct
+import selectors
+import threading
+import importlib
 import re
 import shutil
 import argparse
 import stat
+from collections import namedtuple
 from enum import Enum
 import configparser
 import socket
-import subprocess
 import shlex
 import time
-from platformdirs import user_config_dir
-import paramiko
-from paramiko import (
-    AuthenticationException,
-    SSHException,
-)
-from colorama import init, Fore, Style
+import atexit
+import contextlib
+import mmap
+import zlib
+import signal
+
+
+class LazyModule:
+    """Stands in for a module and imports it the first time one of its
+    attributes is used, so --version, --help and the first-run config path
+    never pay for paramiko (and cryptography) or the other heavy imports"""
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+paramiko = LazyModule("paramiko")
+colorama = LazyModule("colorama")
+platformdirs = LazyModule("platformdirs")
+subprocess = LazyModule("subprocess")
+tarfile = LazyModule("tarfile")
+hashlib = LazyModule("hashlib")
+secrets = LazyModule("secrets")
+futures = LazyModule("concurrent.futures")
+tempfile = LazyModule("tempfile")
+ctypes = LazyModule("ctypes")
 
 REMOTE_DIR = ".zse/"
+WORKSPACE_DIR = f"{REMOTE_DIR}workspaces"
+OBJECTS_DIR = f"{REMOTE_DIR}objects"  # --sync cas blobs, named by sha256
 IGNORE_DIRS = [".git"]
 IGNORE_PREFIXES = ["_", "."]
+IGNORE_FILES = [".gitignore", ".zseignore"]  # read from the synced dir, in order
 VERSION_NO = "1.5.0"
+REMOTE_TERM = "xterm-256color"
+READ_SIZE_MIN = 32 * 1024  # bytes, read_terminal doubles reads up to READ_SIZE_MAX
+READ_SIZE_MAX = 1024 * 1024
+DEFAULT_JOBS = 4  # concurrent SFTP channels used for transfers
+TAR_SYNC_THRESHOLD = 50  # files, --sync auto streams a tar at or above this
+DAEMON_SOCKET = "daemon.sock"
+DAEMON_IDLE_TIMEOUT = 15 * 60  # seconds
+THROUGHPUT_FILE = "throughput.json"  # in the cache dir, feeds --dry-run estimates
+THROUGHPUT_MIN_BYTES = 1024 * 1024  # smaller uploads only measure per-file cost
+GUARD_DEFAULTS = {  # the [limits] section of config.ini overrides these
+    "max_file_size": "100M",  # larger files are skipped
+    "max_total_size": "1G",  # the sync stops above this
+    "max_files": "10000",  # the sync stops above this
+    "executables": "skip",  # linked ELF/Mach-O/PE files, core dumps: skip/warn/allow
+    "archives": "warn",  # zip/gzip/bzip2/xz/7z/zstd/rar/tar files: skip/warn/allow
+}
+MACHO_MAGIC = {  # thin Mach-O magic -> byte order of the header
+    b"\xfe\xed\xfa\xce": "big",
+    b"\xfe\xed\xfa\xcf": "big",
+    b"\xce\xfa\xed\xfe": "little",
+    b"\xcf\xfa\xed\xfe": "little",
+}
+ELF_EXECUTABLE_TYPES = (2, 3, 4)  # ET_EXEC, ET_DYN, ET_CORE, so .o files are kept
+JAVA_MIN_MAJOR = 45  # cafebabe starts Java classes too, their version is 45+
+ARCHIVE_MAGIC = (
+    b"PK\x03\x04",
+    b"\x1f\x8b",
+    b"BZh",
+    b"\xfd7zXZ\x00",
+    b"7z\xbc\xaf\x27\x1c",
+    b"\x28\xb5\x2f\xfd",
+    b"Rar!\x1a\x07",
+)
+DELTA_THRESHOLD = 1024 * 1024  # bytes, --sticky sends changed files this big as deltas
+DELTA_MAX_LITERAL = 0.5  # fraction of a file, more new data than this sends it whole
+DELTA_PROBE_BLOCKS = 64  # blocks searched for a first match before giving up
+DELTA_MAX_SCAN = 0.1  # fraction of a file searched byte by byte, then per block
+DELTA_HELPER = r"""
+import hashlib, os, struct, sys, zlib
+mode, path, size = sys.argv[1], sys.argv[2], int(sys.argv[3])
+out, inp = sys.stdout.buffer, sys.stdin.buffer
+if mode == "signature":
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(size), b""):
+            if len(block) == size:  # a short last block can never match
+                out.write(struct.pack("!I", zlib.adler32(block)))
+                out.write(hashlib.blake2b(block, digest_size=16).digest())
+    sys.exit(0)
+def read(n):
+    data = inp.read(n)
+    if len(data) != n:
+        sys.exit("truncated delta")
+    return data
+tmp = path + ".zse-delta"
+digest = hashlib.sha256()
+with open(path, "rb") as old, open(tmp, "wb") as new:
+    while True:
+        op = read(1)
+        if op == b"C":
+            index, count = struct.unpack("!QI", read(12))
+            old.seek(index * size)
+            for _ in range(count):
+                data = old.read(size)
+                digest.update(data)
+                new.write(data)
+        elif op == b"L":
+            data = read(struct.unpack("!I", read(4))[0])
+            digest.update(data)
+            new.write(data)
+        else:
+            break
+if op != b"E" or read(32) != digest.digest():
+    os.remove(tmp)
+    sys.exit("delta does not reproduce the file")
+os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+os.replace(tmp, path)
+"""
+CAS_GC_DAYS = 14  # blobs no workspace has linked for this long are deleted
+CAS_GC_INTERVAL = 1  # days between garbage collections of the blob store
+# runs in the incoming dir a --sync cas tar was extracted into: moves the new
+# blobs into the store read-only, then hardlinks the manifest into workspace $1
+CAS_LINK_SCRIPT = r"""
+for f in ??/*; do
+  [ -e "$f" ] || continue
+  mkdir -p "../${f%/*}" && chmod a-w "$f" && mv -f "$f" "../$f" || exit 1
+done
+incoming=$(pwd) && objects=$(cd .. && pwd) && cd && cd "$1" || exit 1
+while IFS= read -r name && IFS= read -r path; do
+  if [ "$name" = / ]; then
+    mkdir -p "$path" || exit 1
+  else
+    ln -f "$objects/$name" "$path" 2>/dev/null || cp "$objects/$name" "$path" || exit 1
+  fi
+done < "$incoming/manifest"
+rm -rf "$incoming"
+"""
+RSYNC_RELAY = "--rsync-relay"  # argv[1] when rsync runs zse as its remote shell
+RSYNC_SOCKET_ENV = "ZSE_RSYNC_SOCKET"
+HASH_INDEX_FILE = "hashes.json"  # in the cache dir, file hashes kept between runs
+HASH_INDEX_MAX_AGE = 30 * 24 * 3600  # seconds, roots unused for longer are dropped
+HASH_INDEX_MAX_FILES = 100_000  # oldest roots are dropped to stay under this
+WATCH_DEBOUNCE = 0.3  # seconds of quiet after a burst of saves before --watch syncs
+WATCH_POLL_INTERVAL = 1.0  # seconds between scans where inotify is unavailable
+INOTIFY_MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+INOTIFY_CREATE = 0x100 | 0x80  # IN_CREATE | IN_MOVED_TO
+INOTIFY_ISDIR = 0x40000000
+PROGRESS_INTERVAL = 0.1  # seconds, the progress line is redrawn at most 10 Hz
+
+
+LocalEntry = namedtuple(
+    "LocalEntry",
+    ["path", "relpath", "is_dir", "size", "mtime_ns", "mode", "is_symlink", "inode"],
+)
 
 
 class Error(Enum):
@@ -36,6 +181,7 @@ class Error(Enum):
     AUTH = 1
     EMPTY = 2
     REMOVAL = 3
+    LIMITS = 4
 
 
 class Status(Enum):
@@ -53,9 +199,33 @@ class Status(Enum):
 
 def main():
     """Main function for program"""
-    init()  # initialises colourama
+    if len(sys.argv) > 1 and sys.argv[1] == RSYNC_RELAY:
+        sys.exit(rsync_relay(sys.argv[2:]))
     args = setup_argparse()
+    colorama.init()
     check_configs()
+    if args.timings or args.timings_json:
+        timings.enabled = True
+        atexit.register(timings.report, args.timings, args.timings_json)
+    if args.trace:
+        timings.enabled = timings.tracing = True
+        atexit.register(timings.write_trace, args.trace)
+    if args.daemon:
+        sys.exit(manage_daemon(args))
+    if args.dry_run and not args.sticky:
+        local_dir = args.dir if args.dir else "./"
+        try:
+            entries, warnings, error = (
+                ([], [], None)
+                if should_ignore(local_dir, args)
+                else local_scan.result(local_dir, args)
+            )
+        except OSError as e:  # like read_command, a local error exits with 1
+            sys.stderr.write(f"{colorama.Fore.RED}{e}{colorama.Fore.RESET}\n")
+            sys.exit(1)
+        print_sync_plan(local_dir, entries, args)
+        report_guards(warnings, error)
+        sys.exit(0)
     ssh_connect(args)
     sys.exit(0)
 
@@ -65,13 +235,14 @@ def setup_argparse():
     parser = argparse.ArgumentParser(
         description="CLI tool that allows UNSW students to submit work to CSE machines."
     )
-    parser.add_argument("command", help="The command to execute", nargs="+")
+    parser.add_argument("command", help="The command to execute", nargs="*")
     parser.add_argument(
         "-i",
         "--interactive",
         action="store_true",
-        help="Uploads to a tempdir then opens a real ssh -t session:\n"
-        '  ssh -t ZID@host "cd <tempdir> && <command> && bash; rm -rf <tempdir>"',
+        help="Uploads to a tempdir then runs the command and a bash shell in a "
+        "terminal on the same connection (cd <tempdir> && <command>; bash), "
+        "removing the tempdir when the shell exits",
     )
     parser.add_argument("-V", "--version", action="version", version=VERSION_NO)
     parser.add_argument(
@@ -108,16 +279,105 @@ def setup_argparse():
         nargs="?",
         const="./",
         type=str,
-        help="Excludes folders/files from syncing (default is './' if no value is provided)",
+        help="Excludes folders/files from syncing, comma separated paths or "
+        ".gitignore-style patterns (default is './' if no value is provided). "
+        "Patterns in .gitignore and .zseignore are always applied",
+    )
+    parser.add_argument(
+        "-s",
+        "--sticky",
+        action="store_true",
+        help="Syncs into a persistent remote workspace for this directory, only "
+        "uploading changed files (files the command creates are kept between runs)",
+    )
+    parser.add_argument(
+        "--sync",
+        choices=["auto", "sftp", "tar", "rsync", "cas"],
+        default="auto",
+        help="How files are uploaded: one SFTP transfer per file, a single "
+        f"tar stream (auto uses tar for {TAR_SYNC_THRESHOLD}+ files, with -l "
+        "tar also streams the download), rsync "
+        "tunnelled through the zse connection when both ends have it, or cas, "
+        f"which keeps every uploaded file in ~/{OBJECTS_DIR} and only sends "
+        "files the server has not seen (workspace files are read-only "
+        "hardlinks)",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=["gzip", "zstd"],
+        help="Compresses the tar stream used by --sync tar",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help="Number of files transferred concurrently over SFTP "
+        f"(default: {DEFAULT_JOBS})",
+    )
+    parser.add_argument(
+        "--no-guards",
+        action="store_true",
+        help="Uploads everything, ignoring the [limits] size, file count and "
+        "file type checks",
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="Keeps the connection open after the command finishes, and every "
+        "time a file in the directory is saved uploads just the changes and "
+        "runs the command again (cancelling a run that is still going)",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Lists the files that would be uploaded with per-directory sizes, "
+        "totals and an estimated time, then exits without uploading. With "
+        "--sticky it connects only to diff against the workspace",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Prints how long each phase took, plus files/bytes transferred, "
+        "when zse exits",
+    )
+    parser.add_argument(
+        "--timings-json",
+        metavar="FILE",
+        help="Writes the --timings summary as JSON to FILE ('-' for stdout)",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Writes a Chrome trace-event JSON of the run to FILE, viewable in "
+        "Perfetto or chrome://tracing",
+    )
+    parser.add_argument(
+        "--daemon",
+        nargs="?",
+        const="start",
+        choices=["start", "stop", "status"],
+        help="Starts/stops a background daemon that keeps the SSH connection "
+        "open so later runs skip connecting and authenticating (default: start)",
     )
     args = parser.parse_args()
+    if not args.command and not args.daemon:
+        parser.error("the following arguments are required: command")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.dry_run and args.local:
+        parser.error("--dry-run only plans uploads, it cannot be used with -l")
+    if args.watch and (args.local or args.interactive or args.dry_run):
+        parser.error("--watch cannot be used with -l, -i or --dry-run")
 
     return args
 
 
 def check_configs():
     """Checks if a config file has been setup"""
-    config_dir = user_config_dir("zse")
+    config_dir = platformdirs.user_config_dir("zse")
     file_name = "config.ini"
     file_path = os.path.join(config_dir, file_name)
     if not os.path.isfile(file_path):
@@ -126,7 +386,7 @@ def check_configs():
 
 def create_config():
     """Creates a config file if it doesn't exist, either by copying or generating one."""
-    config_dir = user_config_dir("zse")
+    config_dir = platformdirs.user_config_dir("zse")
     os.makedirs(config_dir, exist_ok=True)
     config_file_path = os.path.join(config_dir, "config.ini")
 
@@ -148,6 +408,17 @@ password =  # optional (but recommended)
 ; private_key_path = ~/.ssh/id_ed25519 # required for key auth
 ; passphrase = # optional if you have set a passphrase
 ; password = # optional if you havent created a keypair
+
+; [daemon] # optional, keeps the connection open between runs
+; autostart = no # start it automatically, otherwise run: zse --daemon
+; idle_timeout = 900 # seconds before an unused daemon exits
+
+; [limits] # optional, guards against slow syncs and full disk quotas
+; max_file_size = 100M # larger files are skipped
+; max_total_size = 1G # the sync stops above this
+; max_files = 10000 # the sync stops above this
+; executables = skip # compiled programs and core dumps: skip, warn or allow
+; archives = warn # zip, tar, gzip etc.: skip, warn or allow
         """
         try:
             with open(config_file_path, "w", encoding="utf-8") as config_file:
@@ -163,12 +434,17 @@ password =  # optional (but recommended)
             sys.exit(0)
 
 
-def ssh_connect(args):
-    """Sets up SSH connection"""
+def read_config():
+    """Reads the user's config.ini"""
     config = configparser.ConfigParser(inline_comment_prefixes="#")
-
-    config_file = os.path.join(user_config_dir("zse"), "config.ini")
+    config_file = os.path.join(platformdirs.user_config_dir("zse"), "config.ini")
     config.read(config_file)
+    return config
+
+
+def ssh_connect(args):
+    """Sets up SSH connection"""
+    config = read_config()
 
     try:
         server_info = config["server"]
@@ -176,9 +452,6 @@ def ssh_connect(args):
     except (KeyError, TypeError, ValueError):
         print_err_msg(Error.AUTH)
 
-    ssh_client = paramiko.SSHClient()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
     try:
         print_status(
             Status.CONNECTING, add=server_info["address"], port=server_info["port"]
@@ -187,62 +460,109 @@ def ssh_connect(args):
         print(config_err)
         print_err_msg(Error.EMPTY)
 
-    if auth_info["type"] == "key":
-        try:
-            ssh_client.connect(
-                hostname=server_info["address"],
-                username=server_info["username"],
-                pkey=paramiko.Ed25519Key(filename=auth_info["private_key_path"]),
-                passphrase=auth_info["passphrase"],
-                password=auth_info["password"],
-                port=int(server_info.get("port", 22)),
-            )
-        except (
-            AuthenticationException,
-            SSHException,
-            socket.error,
-            socket.timeout,
-            KeyboardInterrupt,
-        ) as e:
-            print(e)
-            print_err_msg(Error.CONNECTION)
-    elif auth_info["type"] == "password":
-        try:
-            if (auth_info["password"]) == "":
-                password_var = input("What is your password: ")
-            else:
-                password_var = auth_info["password"]
-
-            ssh_client.connect(
-                hostname=server_info["address"],
-                username=server_info["username"],
-                password=password_var,
-                port=int(server_info.get("port", 22)),
-                look_for_keys=False,
-            )
-        except (
-            AuthenticationException,
-            SSHException,
-            socket.error,
-            socket.timeout,
-            KeyboardInterrupt,
-        ) as e:
-            print(e)
-            print_err_msg(Error.CONNECTION)
-    else:
+    if auth_info["type"] not in ("key", "password"):
         print_err_msg(Error.EMPTY)
+
+    with timings.span("ssh_connect", host=server_info["address"]):
+        ssh_client = daemon_connect(config, args)
+        if not args.local:
+            # only once any daemon autostart has forked, a fork with the scan
+            # thread running could copy a lock it holds into the child
+            local_scan.start(args.dir if args.dir else "./", args)
+        if ssh_client is None:
+            try:
+                ssh_client = open_ssh_client(
+                    server_info, auth_info, get_password(auth_info)
+                )
+            except (
+                paramiko.AuthenticationException,
+                paramiko.SSHException,
+                socket.error,
+                socket.timeout,
+                KeyboardInterrupt,
+            ) as e:
+                print(e)
+                print_err_msg(Error.CONNECTION)
     print_status(Status.AUTHENTICATING, zid=server_info["username"])
     read_command(args, ssh_client)
 
     ssh_client.close()
 
 
+def get_password(auth_info):
+    """Returns the configured password, prompting for it if left empty"""
+    if auth_info["type"] != "password":
+        return None
+    if (auth_info["password"]) == "":
+        return input("What is your password: ")
+    return auth_info["password"]
+
+
+def open_ssh_client(server_info, auth_info, password=None):
+    """Opens an authenticated SSH client, raising if connecting fails"""
+    ssh_client = paramiko.SSHClient()
+    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+    connect_kwargs = {}
+    if timings.enabled:
+        # connect by hand so DNS, TCP and key exchange are timed separately
+        port = int(server_info.get("port", 22))
+        timings.mark("dns lookup")
+        address = socket.getaddrinfo(
+            server_info["address"], port, type=socket.SOCK_STREAM
+        )[0][4]
+        timings.mark("tcp connect")
+        sock = socket.create_connection(address[:2])
+        timings.mark("key exchange")
+        connect_kwargs = {"sock": sock, "transport_factory": timed_transport}
+
+    if auth_info["type"] == "key":
+        ssh_client.connect(
+            hostname=server_info["address"],
+            username=server_info["username"],
+            pkey=paramiko.Ed25519Key(filename=auth_info["private_key_path"]),
+            passphrase=auth_info["passphrase"],
+            password=auth_info["password"],
+            port=int(server_info.get("port", 22)),
+            **connect_kwargs,
+        )
+    else:
+        ssh_client.connect(
+            hostname=server_info["address"],
+            username=server_info["username"],
+            password=password,
+            port=int(server_info.get("port", 22)),
+            look_for_keys=False,
+            **connect_kwargs,
+        )
+    return ssh_client
+
+
+def timed_transport(*args, **kwargs):
+    """Creates the SSH transport, marking when key exchange has finished"""
+    transport = paramiko.Transport(*args, **kwargs)
+    start_client = transport.start_client
+
+    def timed_start_client(*start_args, **start_kwargs):
+        start_client(*start_args, **start_kwargs)
+        timings.mark("authentication")
+
+    transport.start_client = timed_start_client
+    return transport
+
+
+def traced_exec(ssh_client, command, **kwargs):
+    """Runs ssh_client.exec_command, recording the request as a trace span"""
+    with timings.span("exec_command", command=command):
+        return ssh_client.exec_command(command, **kwargs)
+
+
 def read_command(args, ssh_client):
     """Reads the user command, and directs to correct function"""
     try:
         execute_user_command(ssh_client, args)
     except (
-        SSHException,
+        paramiko.SSHException,
         IOError,
         OSError,
         subprocess.CalledProcessError,
@@ -253,33 +573,22 @@ def read_command(args, ssh_client):
 
 def execute_user_command(ssh_client, args, s=None):
     """Executes the user's command in the remote shell (for non pipe option)"""
-    if args.clear:
-        if args.verbose:
-            print(f"Clearing remote directory {REMOTE_DIR}")
-        _stdin, stdout, _stderr = ssh_client.exec_command(f"rm -r {REMOTE_DIR}")
-        exit_code = stdout.channel.recv_exit_status()
-        while exit_code != 0:
-            try:
-                if args.verbose:
-                    print(f"Command failed with exit code {exit_code}. Retrying...")
-                _stdin, stdout, _stderr = ssh_client.exec_command(f"rm -r {REMOTE_DIR}")
-                exit_code = stdout.channel.recv_exit_status()
-            except KeyboardInterrupt:
-                print_err_msg(Error.REMOVAL)
-
-    _stdin, stdout, _stderr = ssh_client.exec_command(f"test -d {REMOTE_DIR}")
-    exit_status = stdout.channel.recv_exit_status()
+    local_dir = args.dir if args.dir else "./"
 
-    if not exit_status == 0:
-        ssh_client.exec_command(f"mkdir -m {700} -p {REMOTE_DIR}")
-        if args.verbose:
-            print(f"Directory '{REMOTE_DIR}' created with permissions {700}.")
+    if args.sticky and not args.local:
+        remote_dir = sticky_workspace(local_dir)
+    else:
+        remote_dir = os.path.join(REMOTE_DIR, secrets.token_hex(4))
+    if args.dry_run:
+        sticky_dry_run(ssh_client.open_sftp(), ssh_client, local_dir, remote_dir, args)
+        ssh_client.close()
+        sys.exit(0)
+    prepare_remote(ssh_client, remote_dir, args)
 
     print_status(Status.SFTP)
     sftp = ssh_client.open_sftp()
-    local_dir = args.dir if args.dir else "./"
-
-    remote_dir = os.path.join(REMOTE_DIR, secrets.token_hex(4))
+    if not args.local:
+        timings.mark("sync")
 
     if args.local:
         run_and_download(sftp, remote_dir, ssh_client, args)
@@ -287,106 +596,447 @@ def execute_user_command(ssh_client, args, s=None):
         upload_and_run(sftp, local_dir, remote_dir, ssh_client, args)
 
 
+def prepare_remote(ssh_client, remote_dir, args):
+    """Clears the zse folder (with -c) and creates remote_dir with private
+    permissions in a single command, instead of one round trip per step"""
+    steps = ["umask 077"]
+    if args.clear:
+        if args.verbose:
+            print(f"Clearing remote directory {REMOTE_DIR}")
+        steps.append(f"rm -rf {shlex.quote(REMOTE_DIR)}")
+    steps.append(f"mkdir -p {shlex.quote(remote_dir)}")
+
+    start = time.monotonic()
+    _stdin, stdout, stderr = traced_exec(ssh_client, " && ".join(steps))
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        sys.stderr.write(stderr.read().decode(errors="replace"))
+        if args.clear:
+            print_err_msg(Error.REMOVAL)
+        raise paramiko.SSHException(f"Could not create remote directory {remote_dir}")
+    if args.verbose:
+        elapsed = (time.monotonic() - start) * 1000
+        print(f"Prepared '{remote_dir}' in one round trip ({elapsed:.0f} ms)")
+
+
+def remote_command(remote_dir, command, cleanup):
+    """Wraps a user command so it runs in remote_dir with TERM set, optionally
+    deleting remote_dir when the shell exits (including after Ctrl-C)"""
+    wrapped = f"export TERM={REMOTE_TERM}; "
+    if cleanup:
+        wrapped += f"trap 'cd && rm -rf {shlex.quote(remote_dir)}' EXIT; "
+    return wrapped + f'cd "{remote_dir}" && {command}'
+
+
 def upload_and_run(sftp, local_dir, remote_dir, ssh_client, args, *, s=None):
     """Uploads local files and runs user command"""
     if args.verbose:
         print(f"Files will be uploaded to: {remote_dir}")
 
-    sftp.mkdir(remote_dir)
-    sftp_recursive_put(sftp, local_path=local_dir, remote_path=remote_dir, args=args)
+    start = time.monotonic()
+    if args.sticky:
+        entries = sticky_sync(sftp, ssh_client, local_dir, remote_dir, args)
+    else:
+        entries = sync_local_tree(sftp, ssh_client, local_dir, remote_dir, args)
+    save_throughput(time.monotonic() - start)
     print_status(Status.SYNCING)
 
     if not args.interactive:
-        ssh_client.exec_command("export TERM=xterm-256color")
         give_bypassed_user_cmd = (
             ("yes | " + " ".join(args.command))
             if args.command[0].split()[0]
             in ("give",)  # add more stuff to auto bypass if needed
             else " ".join(args.command)
         )
-        command = f'cd "{remote_dir}" && {give_bypassed_user_cmd}'
+        command = remote_command(
+            remote_dir,
+            give_bypassed_user_cmd,
+            cleanup=not args.sticky and not args.watch,
+        )
         if args.verbose:
             print(f"Running command: {command}")
         print_status(Status.SENT, command=" ".join(args.command))
         print_status(Status.OUTPUT)
+        if args.watch:
+            watch_and_run(
+                sftp, local_dir, remote_dir, ssh_client, args, command, entries
+            )
+            ssh_client.close()
+            sys.exit(0)
 
-        _stdin, stdout, stderr = ssh_client.exec_command(command, get_pty=True)
+        _stdin, stdout, stderr = traced_exec(ssh_client, command, get_pty=True)
         try:
             read_terminal(stdout, stderr)
         except KeyboardInterrupt:
             pass
 
-        ssh_client.exec_command(f"rm -rf ~/{shlex.quote(remote_dir)}")
-        if args.verbose:
+        if args.verbose and not args.sticky:
             print(f"Cleared remote directory {remote_dir}")
 
         ssh_client.close()
         sys.exit(0)
 
-    # --- New -p behavior: system ssh -t session ---
     try:
         sftp.close()
     except Exception:
         pass
-    try:
-        ssh_client.close()
-    except Exception:
-        pass
-
-    config = configparser.ConfigParser(inline_comment_prefixes="#")
-    config_file = os.path.join(user_config_dir("zse"), "config.ini")
-    config.read(config_file)
-    server_info = config["server"]
-    auth_info = config["auth"]
-
-    user = server_info["username"]
-    host = server_info["address"]
-    port = str(server_info.getint("port", fallback=22))
 
     remote_cmd = (
         shlex.join(["cd", remote_dir])  # cd into temp dir
         + (
             (" && " + " ".join(args.command)) if args.command else ""
         )  # run user command
-        + "; bash; "  # launch shell
-        + " ".join(["rm", "-rf", "~/" + shlex.quote(remote_dir)])  # delete temp dir
+        + "; bash"  # launch shell
+        + (
+            "" if args.sticky else "; rm -rf ~/" + shlex.quote(remote_dir)
+        )  # delete temp dir
     )
-    # print("Remote cmd:", remote_cmd)
-
-    ssh_cmd = ["ssh", "-t", "-p", port, f"{user}@{host}", remote_cmd]
-
-    pw = auth_info.get("password", "").strip()
-    if auth_info.get("type", "password") == "password" and pw:
-        if shutil.which("sshpass"):
-            ssh_cmd = ["sshpass", "-p", pw] + ssh_cmd
-        elif args.verbose:
-            print(
-                "sshpass not found; falling back to interactive SSH prompt. "
-                "Tip: install sshpass or use key auth in config.ini."
-            )
-
     if args.verbose:
-        print(f"Launching interactive session: {' '.join(ssh_cmd)}")
+        print(f"Opening interactive session: {remote_cmd}")
 
     print_status(Status.SENT, command=" ".join(args.command))
     print_status(Status.OUTPUT)
 
-    proc = subprocess.Popen(ssh_cmd, stdin=None, stdout=None, stderr=None)
-    rc = proc.wait()
+    rc = run_interactive(ssh_client, remote_cmd)
+    ssh_client.close()
 
     print_status(Status.END_OUTPUT)
     print_status(Status.EXIT_STAT, exit_stat=rc)
     sys.exit(rc)
 
 
+def open_terminal(ssh_client, command):
+    """Runs command in a pty sized like the local terminal, returning its
+    channel. Uses the connection zse already has, so there is no second
+    handshake or password prompt"""
+    term = os.environ.get("TERM", REMOTE_TERM)
+    width, height = shutil.get_terminal_size()
+    with timings.span("exec_command", command=command):
+        if isinstance(ssh_client, DaemonClient):
+            return ssh_client.open_terminal(command, term, width, height)
+        chan = ssh_client.get_transport().open_session()
+        chan.get_pty(term=term, width=width, height=height)
+        chan.exec_command(command)
+        return chan
+
+
+def run_interactive(ssh_client, command):
+    """Runs command in a remote terminal wired to the local one: keys go out
+    as they are typed (the local tty is in raw mode, so Ctrl-C and friends
+    reach the remote side), output is written as soon as it arrives and
+    resizing the window resizes the remote pty. Returns the exit status"""
+    chan = open_terminal(ssh_client, command)
+    sel = selectors.DefaultSelector()
+    sel.register(chan, selectors.EVENT_READ, "chan")
+    stdin_fd = sys.stdin.fileno()
+    size = shutil.get_terminal_size()
+    saved_tty = resize_pipe = old_winch = None
+    if os.name == "posix":
+        # pylint: disable=import-outside-toplevel
+        import termios
+        import tty
+
+        if os.isatty(stdin_fd):
+            saved_tty = termios.tcgetattr(stdin_fd)
+            tty.setraw(stdin_fd)
+        stdin_mode = os.fstat(stdin_fd).st_mode
+        if saved_tty or stat.S_ISFIFO(stdin_mode) or stat.S_ISSOCK(stdin_mode):
+            sel.register(stdin_fd, selectors.EVENT_READ, "stdin")
+        else:  # a regular file or /dev/null, which epoll refuses
+            threading.Thread(
+                target=send_stdin, args=(chan, stdin_fd), name="stdin", daemon=True
+            ).start()
+        # the handler only wakes the loop, which sends the resize itself so it
+        # cannot land in the middle of another write to the channel
+        resize_pipe = os.pipe()
+        sel.register(resize_pipe[0], selectors.EVENT_READ, "resize")
+        old_winch = signal.signal(
+            signal.SIGWINCH, lambda *_: os.write(resize_pipe[1], b"w")
+        )
+    else:
+        threading.Thread(
+            target=send_console_keys, args=(chan,), name="keys", daemon=True
+        ).start()
+
+    try:
+        while True:
+            # no SIGWINCH off POSIX, so the size is checked on every timeout
+            for key, _ in sel.select(timeout=None if resize_pipe else 0.5):
+                if key.data == "stdin":
+                    data = os.read(stdin_fd, 4096)
+                    if data:
+                        chan.sendall(data)
+                    else:
+                        sel.unregister(stdin_fd)
+                        chan.shutdown_write()
+                elif key.data == "resize":
+                    os.read(resize_pipe[0], 4096)
+            if shutil.get_terminal_size() != size:
+                size = shutil.get_terminal_size()
+                chan.resize_pty(width=size.columns, height=size.lines)
+            while chan.recv_stderr_ready():
+                sys.stdout.buffer.write(chan.recv_stderr(65536))
+            if chan.recv_ready():
+                sys.stdout.buffer.write(chan.recv(65536))
+            elif chan.exit_status_ready():
+                break
+            sys.stdout.flush()
+    finally:
+        sys.stdout.flush()
+        sel.close()
+        if saved_tty is not None:
+            termios.tcsetattr(stdin_fd, termios.TCSADRAIN, saved_tty)
+        if resize_pipe is not None:
+            signal.signal(signal.SIGWINCH, old_winch)
+            for fd in resize_pipe:
+                os.close(fd)
+    return chan.recv_exit_status()
+
+
+def send_stdin(chan, stdin_fd):
+    """Sends a stdin that cannot be polled to the channel, then EOF"""
+    try:
+        for data in iter(lambda: os.read(stdin_fd, 65536), b""):
+            chan.sendall(data)
+        chan.shutdown_write()
+    except (OSError, paramiko.SSHException):
+        pass
+
+
+def send_console_keys(chan):
+    """Sends keys from the Windows console as they are pressed, turning the
+    arrow, home/end and delete keys into the escape codes a remote shell
+    expects"""
+    import msvcrt  # pylint: disable=import-outside-toplevel,import-error
+
+    special = {
+        "H": "\x1b[A",
+        "P": "\x1b[B",
+        "M": "\x1b[C",
+        "K": "\x1b[D",
+        "G": "\x1b[H",
+        "O": "\x1b[F",
+        "S": "\x1b[3~",
+    }
+    try:
+        while not chan.closed:
+            key = msvcrt.getwch()
+            if key in ("\x00", "\xe0"):
+                key = special.get(msvcrt.getwch(), "")
+            if key:
+                chan.sendall(key.encode())
+    except (OSError, paramiko.SSHException):
+        pass
+
+
+def watch_and_run(sftp, local_dir, remote_dir, ssh_client, args, command, entries):
+    """Runs command, then re-syncs local_dir and runs it again every time a
+    file under it changes, until Ctrl-C while waiting. entries are what the
+    first sync uploaded. A run still going when files change is cancelled
+    first. The remote dir is removed at the end unless it is a --sticky
+    workspace"""
+    snapshot = tree_snapshot(entries)
+    try:
+        with TreeWatcher(local_dir, args) as watcher:
+            while True:
+                _stdin, stdout, stderr = traced_exec(ssh_client, command, get_pty=True)
+                read_terminal(stdout, stderr, cancel=watcher)
+                if not watcher.pending():
+                    print(f"Watching {local_dir} for changes (Ctrl-C to stop)")
+                while True:  # changes that sync nothing keep waiting quietly
+                    watcher.wait()
+                    snapshot, changes = watch_sync(
+                        sftp, ssh_client, local_dir, remote_dir, args, snapshot
+                    )
+                    if changes:
+                        break
+                print_status(Status.OUTPUT)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        if not args.sticky:
+            _stdin, stdout, _stderr = traced_exec(
+                ssh_client, f"rm -rf {shlex.quote(remote_dir)}"
+            )
+            stdout.channel.recv_exit_status()
+            if args.verbose:
+                print(f"Cleared remote directory {remote_dir}")
+
+
+def watch_sync(sftp, ssh_client, local_dir, remote_dir, args, snapshot):
+    """Rescans local_dir and uploads what changed since snapshot, removing
+    what was deleted. Returns the new snapshot and the number of changes"""
+    ignore_matchers.clear()  # .gitignore itself may have been edited
+    local_scan.start(local_dir, args)
+    entries, warnings, error = local_scan.result(local_dir, args)
+    current = tree_snapshot(entries)
+    changed = [
+        entry
+        for entry in entries
+        if snapshot.get(entry.relpath) != current[entry.relpath]
+    ]
+    removed = sorted(set(snapshot) - set(current))
+    if not changed and not removed:
+        report_guards([], error)  # warnings were shown by an earlier sync
+        return current, 0
+
+    report_guards(warnings, error)
+    print(f"Syncing {len(changed)} changed and {len(removed)} removed paths")
+    if args.sticky:
+        sticky_sync(sftp, ssh_client, local_dir, remote_dir, args, entries)
+    else:
+        if removed:
+            remove_remote_paths(ssh_client, remote_dir, removed, args)
+        if changed:
+            upload_entries(sftp, ssh_client, local_dir, changed, remote_dir, args)
+    return current, len(changed) + len(removed)
+
+
+def tree_snapshot(entries):
+    """Maps relpath -> what a change to it would alter. Directories only
+    count as changed when they appear or disappear, not when their mtime
+    moves because a file inside was saved"""
+    return {
+        entry.relpath: (
+            (True,)
+            if entry.is_dir
+            else (False, entry.size, entry.mtime_ns, entry.inode, entry.mode)
+        )
+        for entry in entries
+    }
+
+
+def open_inotify():
+    """Returns (libc, inotify fd), or None where inotify is not available"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    return (libc, fd) if fd >= 0 else None
+
+
+class TreeWatcher:
+    """Watches a local tree on a background thread, with inotify where it is
+    available and by rescanning every WATCH_POLL_INTERVAL elsewhere. Once a
+    burst of changes has been quiet for WATCH_DEBOUNCE, fileno() turns
+    readable, so the watcher can be passed to a selector"""
+
+    def __init__(self, local_path, args):
+        self.local_path = local_path
+        self.args = argparse.Namespace(**{**vars(args), "verbose": False})
+        self.read_fd, self.write_fd = os.pipe()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="watcher", daemon=True)
+
+    def fileno(self):
+        """The pipe end that is readable while a change is pending"""
+        return self.read_fd
+
+    def pending(self):
+        """Whether a change is waiting to be picked up by wait()"""
+        with selectors.DefaultSelector() as sel:
+            sel.register(self.read_fd, selectors.EVENT_READ)
+            return bool(sel.select(timeout=0))
+
+    def wait(self):
+        """Blocks until files have changed, then clears the signal"""
+        os.read(self.read_fd, 4096)
+
+    def changed(self):
+        """Signals a settled burst of changes"""
+        os.write(self.write_fd, b"\0")
+
+    def run(self):
+        """Watches with inotify, falling back to polling"""
+        inotify = open_inotify()
+        if inotify is None:
+            self.poll()
+            return
+        libc, fd = inotify
+        try:
+            if not self.watch_dirs(libc, fd):
+                self.poll()
+                return
+            self.read_inotify(libc, fd)
+        finally:
+            os.close(fd)
+
+    def watch_dirs(self, libc, fd):
+        """Adds a watch for the root and every directory that is synced,
+        returning False if even the root could not be watched"""
+        if libc.inotify_add_watch(fd, os.fsencode(self.local_path), INOTIFY_MASK) < 0:
+            return False
+        for entry in walk_local_tree(self.local_path, self.args):
+            if entry.is_dir:  # adding a watched dir again is a no-op
+                libc.inotify_add_watch(fd, os.fsencode(entry.path), INOTIFY_MASK)
+        return True
+
+    def read_inotify(self, libc, fd):
+        """Waits for inotify events, signalling once they stop for
+        WATCH_DEBOUNCE. New directories are watched before signalling, so
+        saves inside them are seen too"""
+        pending = new_dirs = False
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            while not self.stopped.is_set():
+                if not sel.select(timeout=WATCH_DEBOUNCE if pending else 1):
+                    if new_dirs:
+                        self.watch_dirs(libc, fd)
+                    if pending:
+                        self.changed()
+                    pending = new_dirs = False
+                    continue
+                try:
+                    data = os.read(fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                offset = 0
+                while offset < len(data):
+                    _wd, mask, _cookie, length = struct.unpack_from(
+                        "iIII", data, offset
+                    )
+                    offset += 16 + length
+                    if mask & INOTIFY_ISDIR and mask & INOTIFY_CREATE:
+                        new_dirs = True
+                pending = True
+
+    def poll(self):
+        """Rescans the tree every WATCH_POLL_INTERVAL, signalling once a
+        change stops changing further"""
+        snapshot = self.snapshot()
+        while not self.stopped.wait(WATCH_POLL_INTERVAL):
+            current = self.snapshot()
+            if current == snapshot:
+                continue
+            while not self.stopped.wait(WATCH_DEBOUNCE):
+                latest = self.snapshot()
+                if latest == current:
+                    break
+                current = latest
+            snapshot = current
+            self.changed()
+
+    def snapshot(self):
+        """Returns the tree_snapshot of the watched tree"""
+        return tree_snapshot(walk_local_tree(self.local_path, self.args))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+
+
 def run_and_download(sftp, remote_dir, ssh_client, args):
     """Runs remote command and downloads files from dir"""
 
-    sftp.mkdir(remote_dir)
-    ssh_client.exec_command("export TERM=xterm-256color")
-    command = f'cd "{remote_dir}" && {" ".join(args.command)}'
+    command = remote_command(remote_dir, " ".join(args.command), cleanup=False)
     print_status(Status.SENT, command=" ".join(args.command))
-    _stdin, stdout, stderr = ssh_client.exec_command(command, get_pty=True)
+    _stdin, stdout, stderr = traced_exec(ssh_client, command, get_pty=True)
 
     if args.local:
         local_dir = args.local
@@ -399,92 +1049,286 @@ def run_and_download(sftp, remote_dir, ssh_client, args):
     except KeyboardInterrupt:
         pass
 
-    download_dir(sftp, remote_dir, local_dir, args)
+    timings.mark("download")
+    if args.sync != "tar" or not tar_download(ssh_client, remote_dir, local_dir, args):
+        download_dir(sftp, remote_dir, local_dir, args, ssh_client)
 
-    ssh_client.exec_command(f"rm -rf ~/{shlex.quote(remote_dir)}")
+    traced_exec(ssh_client, f"rm -rf ~/{shlex.quote(remote_dir)}")
     if args.verbose:
         print(f"Cleared remote directory {remote_dir}")
 
     sys.exit(0)
 
 
-def read_terminal(stdout, stderr):
+def read_terminal(stdout, stderr, cancel=None):
     """
-    Stream stdout/stderr in (semi) real-time without blocking forever on readline().
-    Interleaves both streams and allows KeyboardInterrupt to be raised promptly.
+    Stream stdout/stderr in real-time, waking up as soon as the channel has data
+    instead of polling. Reads grow while output keeps filling them, so large
+    outputs stream at link speed. Allows KeyboardInterrupt to be raised promptly.
+    The command is interrupted the same way once cancel (anything selectable,
+    like a TreeWatcher) becomes readable.
     """
     chan = stdout.channel  # same channel backs both stdout/stderr
-    chan.settimeout(0.1)  # short timeout makes the loop interruptible
+    sel = selectors.DefaultSelector()
+    sel.register(chan, selectors.EVENT_READ)  # readable while data is buffered
+    if cancel is not None:
+        sel.register(cancel, selectors.EVENT_READ)
+    sizes = {"stdout": READ_SIZE_MIN, "stderr": READ_SIZE_MIN}
+
+    def drain(ready, recv, out, name):
+        if not ready():
+            return
+        while ready():
+            data = recv(sizes[name])
+            out.write(data)
+            if len(data) == sizes[name]:
+                sizes[name] = min(sizes[name] * 2, READ_SIZE_MAX)
+        out.flush()
+
+    with timings.span("read_terminal"):
+        try:
+            while True:
+                # the timeout only matters if the exit status arrives without data
+                ready = sel.select(timeout=1)
+                if any(key.fileobj is cancel for key, _events in ready):
+                    print(
+                        f"\n{colorama.Fore.YELLOW}Files changed, cancelling the "
+                        + f"running command{colorama.Fore.RESET}"
+                    )
+                    chan.send("\x03")  # Ctrl c
+                    chan.send("\x04")  # Ctrl d
+                    break
+                drain(chan.recv_ready, chan.recv, sys.stdout.buffer, "stdout")
+                drain(
+                    chan.recv_stderr_ready,
+                    chan.recv_stderr,
+                    sys.stderr.buffer,
+                    "stderr",
+                )
 
-    try:
-        while True:
-            try:
-                if chan.recv_ready():
-                    sys.stdout.buffer.write(chan.recv(4096))
-                    sys.stdout.flush()
-                if chan.recv_stderr_ready():
-                    sys.stderr.buffer.write(chan.recv_stderr(4096))
-                    sys.stderr.flush()
-            except socket.timeout:
-                pass  # just poll again
+                if (
+                    chan.exit_status_ready()
+                    and not chan.recv_ready()
+                    and not chan.recv_stderr_ready()
+                ):
+                    break
+        except KeyboardInterrupt:
+            print()
+            chan.send("\x03")  # Ctrl c
+            chan.send("\x04")  # Ctrl d
+        finally:
+            sel.close()
+            print_status(Status.END_OUTPUT)
+            # print("Sent CTRL-C to server")
+            # Send CTRL-C to the server so we dont have infinite loop if server is in a loop.
+            exit_status = chan.recv_exit_status()
+
+            print_status(Status.EXIT_STAT, exit_stat=exit_status)
 
-            if chan.exit_status_ready():
-                break
 
-            time.sleep(0.03)  # keep CPU calm
+def download_dir(sftp, remote_path, local_path, args, ssh_client=None):
+    """Recursively download remote directories and their files."""
+    try:
+        files = []
+        dirs = []
+        if ssh_client is None or not list_remote_find(
+            ssh_client, remote_path, local_path, files, dirs, args
+        ):
+            list_remote_tree(sftp, remote_path, local_path, files, dirs, args)
+
+        selected = [job for job in files if confirm_download(*job[1:], args)]
+        progress = Progress(
+            "Downloading", len(selected), sum(job[0].st_size or 0 for job in selected)
+        )
+        jobs = [
+            lambda client, job=job: handle_file(client, *job, args, progress)
+            for job in selected
+        ]
+        try:
+            run_sftp_jobs(ssh_client, sftp, jobs, args)
+        finally:
+            progress.finish()
+
+        if args.clear:
+            for remote_item_path in reversed(dirs):
+                sftp.rmdir(remote_item_path)
+                if args.verbose:
+                    print(f"Deleted remote directory: {remote_item_path}")
     except KeyboardInterrupt:
-        print()
-        chan.send("\x03")  # Ctrl c
-        chan.send("\x04")  # Ctrl d
-    finally:
-        print_status(Status.END_OUTPUT)
-        # print("Sent CTRL-C to server")
-        # Send CTRL-C to the server so we dont have infinite loop if server is in a loop.
-        exit_status = chan.recv_exit_status()
+        print(
+            colorama.Fore.RED
+            + "\nConnection closed by user."
+            + colorama.Style.RESET_ALL
+        )
+        sys.exit(0)
 
-        print_status(Status.EXIT_STAT, exit_stat=exit_status)
+
+def tar_download(ssh_client, remote_path, local_path, args):
+    """Streams remote_path as one tar archive from `tar c` and extracts it
+    while it arrives, asking about each existing file as its turn comes.
+    Returns False if the stream failed before anything was written, so the
+    caller can fall back to SFTP"""
+    create = "tar -cf - ."
+    mode = "r|"
+    if args.compress == "gzip":
+        create = "tar -czf - ."
+        mode = "r|gz"
+    elif args.compress == "zstd":
+        create = "tar -cf - . | zstd -cq"
+    command = f"cd {shlex.quote(remote_path)} && {create}"
+
+    extracted = 0
+    try:
+        _stdin, stdout, stderr = traced_exec(ssh_client, command)
+        stream = stdout
+        if args.compress == "zstd":
+            import zstandard  # pylint: disable=import-outside-toplevel
+
+            stream = zstandard.ZstdDecompressor().stream_reader(stdout)
+        with timings.span("tar download"), tarfile.open(
+            fileobj=stream, mode=mode
+        ) as tar:
+            for member in tar:
+                if extract_member(tar, member, remote_path, local_path, args):
+                    extracted += 1
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            message = stderr.read().decode(errors="replace").strip()
+            raise paramiko.SSHException(
+                f"remote tar exited with {exit_status}: {message}"
+            )
+    except (ImportError, tarfile.TarError, paramiko.SSHException, OSError) as e:
+        if not extracted:
+            sys.stderr.write(
+                f"{colorama.Fore.YELLOW}Tar download failed ({e}), falling back "
+                + f"to SFTP{colorama.Fore.RESET}\n"
+            )
+            return False
+        sys.stderr.write(
+            f"{colorama.Fore.RED}Tar download stopped after {extracted} files: "
+            + f"{e}{colorama.Fore.RESET}\n"
+        )
+    return True
+
+
+def extract_member(tar, member, remote_path, local_path, args):
+    """Writes one member of a download stream under local_path, applying the
+    same overwrite check as SFTP downloads. Returns whether a file was
+    written. Members that are not plain files or directories, or that would
+    land outside local_path, are skipped"""
+    relpath = member.name[2:] if member.name.startswith("./") else member.name
+    parts = [part for part in relpath.split("/") if part not in ("", ".")]
+    if os.path.isabs(member.name) or ".." in parts:
+        sys.stderr.write(f"Skipping unsafe path in download: {member.name}\n")
+        return False
+    local_item_path = os.path.join(local_path, *parts)
+    remote_item_path = "/".join([remote_path, *parts])
+    if member.isdir():
+        os.makedirs(local_item_path, exist_ok=True)
+        return False
+    if not member.isfile():
+        if args.verbose:
+            print(f"Skipping {remote_item_path}, not a regular file")
+        return False
+    if not confirm_download(remote_item_path, local_item_path, args):
+        return False  # the stream skips the unread member by itself
+
+    os.makedirs(os.path.dirname(local_item_path), exist_ok=True)
+    with tar.extractfile(member) as src, open(local_item_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.chmod(local_item_path, member.mode & 0o777 | stat.S_IRUSR | stat.S_IWUSR)
+    timings.add_transfer("downloaded", member.size)
+    if args.verbose:
+        print(f"Downloaded: {remote_item_path} to {local_item_path}")
+    return True
 
 
-def download_dir(sftp, remote_path, local_path, args):
-    """Recursively download remote directories and their files."""
+def list_remote_find(ssh_client, remote_path, local_path, files, dirs, args):
+    """Lists the whole remote tree with one `find -printf` exec instead of a
+    listdir round trip per directory, then creates every local directory up
+    front. Fills files and dirs like list_remote_tree, returning False
+    (with nothing filled) when the remote find cannot do this"""
+    command = (
+        f"cd {shlex.quote(remote_path)} && "
+        "find . -mindepth 1 -printf '%y %s %T@ %m %P\\0'"
+    )
+    _stdin, stdout, _stderr = traced_exec(ssh_client, command)
+    output = stdout.read()
+    if stdout.channel.recv_exit_status() != 0:
+        return False
     try:
-        os.makedirs(local_path, exist_ok=True)
+        records = [
+            record.decode().split(" ", 4) for record in output.split(b"\0") if record
+        ]
+    except UnicodeDecodeError:
+        return False
+
+    listed = []
+    for kind, size, mtime, mode, relpath in records:
+        attrs = paramiko.SFTPAttributes()
+        attrs.filename = relpath.rsplit("/", 1)[-1]
+        attrs.st_size = int(size)
+        attrs.st_mtime = int(float(mtime))
+        attrs.st_mode = (stat.S_IFDIR if kind == "d" else stat.S_IFREG) | int(mode, 8)
+        listed.append((attrs, relpath))
+
+    os.makedirs(local_path, exist_ok=True)
+    for attrs, relpath in listed:
+        remote_item_path = f"{remote_path}/{relpath}"
+        local_item_path = os.path.join(local_path, *relpath.split("/"))
+        if stat.S_ISDIR(attrs.st_mode):
+            if args.verbose:
+                print(f"Creating local directory: {local_item_path}")
+            os.makedirs(local_item_path, exist_ok=True)
+            dirs.append(remote_item_path)
+        else:
+            files.append((attrs, remote_item_path, local_item_path))
+    return True
 
-        for item in sftp.listdir_attr(remote_path):
-            remote_item_path = f"{remote_path}/{item.filename}"
-            local_item_path = os.path.join(local_path, item.filename)
 
-            if stat.S_ISDIR(item.st_mode):
-                if args.verbose:
-                    print(f"Entering directory: {remote_item_path}")
-                download_dir(sftp, remote_item_path, local_item_path, args)
+def list_remote_tree(sftp, remote_path, local_path, files, dirs, args):
+    """Walks a remote directory, creating the matching local directories and
+    collecting (attrs, remote path, local path) for every file. Fallback for
+    servers whose find has no -printf"""
+    os.makedirs(local_path, exist_ok=True)
 
-                if args.clear:
-                    sftp.rmdir(remote_item_path)
-                    if args.verbose:
-                        print(f"Deleted remote directory: {remote_item_path}")
-            else:
-                handle_file(sftp, item, remote_item_path, local_item_path, args)
-    except KeyboardInterrupt:
-        print(Fore.RED + "\nConnection closed by user." + Style.RESET_ALL)
-        sys.exit(0)
+    for item in sftp.listdir_attr(remote_path):
+        remote_item_path = f"{remote_path}/{item.filename}"
+        local_item_path = os.path.join(local_path, item.filename)
 
+        if stat.S_ISDIR(item.st_mode):
+            if args.verbose:
+                print(f"Entering directory: {remote_item_path}")
+            dirs.append(remote_item_path)  # parents first, -c removes in reverse
+            list_remote_tree(sftp, remote_item_path, local_item_path, files, dirs, args)
+        else:
+            files.append((item, remote_item_path, local_item_path))
 
-def handle_file(sftp, item, remote_item_path, local_item_path, args):
-    """Handles downloading a single file and optionally clearing it."""
+
+def confirm_download(remote_item_path, local_item_path, args):
+    """Asks before a download would overwrite an existing local file"""
     if args.verbose:
         print(f"Processing file: {remote_item_path}")
 
     if os.path.isfile(local_item_path) and not args.force:
         user_input = input(
-            f"{item.filename} already exists. Replace it? (y/n): "
+            f"{os.path.basename(local_item_path)} already exists. Replace it? (y/n): "
         ).lower()
         if user_input not in ["y", "yes"]:
             if args.verbose:
                 print(f"Skipped: {remote_item_path}")
-            return
+            return False
+    return True
 
-    sftp.get(remote_item_path, local_item_path)
+
+def handle_file(sftp, item, remote_item_path, local_item_path, args, progress=None):
+    """Handles downloading a single file and optionally clearing it."""
+    callback = progress.callback() if progress else None
+    with timings.span("sftp.get", path=remote_item_path, bytes=item.st_size):
+        sftp.get(remote_item_path, local_item_path, callback=callback)
+    timings.add_transfer("downloaded", item.st_size or 0)
+    if progress:
+        progress.file_done()
     if args.verbose:
         print(f"Downloaded: {remote_item_path} to {local_item_path}")
 
@@ -494,29 +1338,1256 @@ def handle_file(sftp, item, remote_item_path, local_item_path, args):
             print(f"Deleted remote file: {remote_item_path}")
 
 
+def run_sftp_jobs(ssh_client, sftp, jobs, args):
+    """Runs jobs (callables taking an SFTP client) on up to --jobs worker
+    threads. Each worker gets its own SFTP channel on the same connection, so
+    transfers overlap instead of waiting on each other's round trips"""
+    workers = min(args.jobs, len(jobs)) if ssh_client is not None else 1
+    if workers <= 1:
+        for job in jobs:
+            job(sftp)
+        return
+
+    spare = [sftp]
+    opened = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def worker_sftp():
+        if not hasattr(local, "sftp"):
+            with lock:
+                local.sftp = spare.pop() if spare else None
+            if local.sftp is None:
+                local.sftp = ssh_client.open_sftp()
+                with lock:
+                    opened.append(local.sftp)
+        return local.sftp
+
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    pending = [executor.submit(lambda job=job: job(worker_sftp())) for job in jobs]
+    try:
+        for future in futures.as_completed(pending):
+            future.result()
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True)
+        for client in opened:
+            client.close()
+
+
 def should_ignore(path, args):
-    """Helper function to determine what files/folders to ignore when syncing"""
-    base_name = os.path.basename(path)
-    ignored_files = IGNORE_DIRS
-    if args.exclude:
+    """Helper function to determine whether a directory being synced was
+    excluded as a whole (e.g. by a bare -e)"""
+    return ignore_matcher(path, args).excludes_root
+
+
+IgnoreRule = namedtuple("IgnoreRule", ["regex", "negate", "dir_only", "anchored"])
+
+
+def compile_ignore_pattern(pattern):
+    """Compiles one .gitignore line into an IgnoreRule, or None for blank
+    lines and comments"""
+    pattern = pattern.rstrip("\n")
+    if not pattern.endswith("\\ "):
+        pattern = pattern.rstrip()
+    if not pattern or pattern.startswith("#"):
+        return None
+    negate = pattern.startswith("!")
+    if negate:
+        pattern = pattern[1:]
+    elif pattern.startswith(("\\#", "\\!")):
+        pattern = pattern[1:]
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    # a slash anywhere but the end ties the pattern to the ignore file's dir
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    if not pattern:
+        return None
+
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex += "/.*"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2 :]:
+            end = pattern.index("]", i + 2)
+            body = pattern[i + 1 : end]
+            negated = body.startswith("!")
+            body = "".join(c if c == "-" else re.escape(c) for c in body[negated:])
+            regex += f"[{'^' if negated else ''}{body}]"
+            i = end + 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return IgnoreRule(re.compile(regex + r"\Z"), negate, dir_only, anchored)
+
+
+class IgnoreMatcher:
+    """Ignore rules compiled once per synced directory: the built in defaults
+    (IGNORE_DIRS and IGNORE_PREFIXES), then .gitignore and .zseignore in that
+    directory, then --exclude. As in git, the last matching rule wins, a
+    leading ! re-includes, a trailing / only matches directories and a slash
+    elsewhere anchors the pattern to the synced directory"""
+
+    def __init__(self, root, args):
+        self.root = os.path.abspath(root)
+        self.rules = []
+        self.excludes_root = False
+        for name in IGNORE_DIRS:
+            self.add(name)
+        for prefix in IGNORE_PREFIXES:
+            self.add(f"{prefix}*")
+        for name in IGNORE_FILES:
+            try:
+                # surrogateescape keeps non-UTF-8 patterns matching the
+                # file names os.scandir decodes the same way
+                with open(
+                    os.path.join(root, name), encoding="utf-8", errors="surrogateescape"
+                ) as f:
+                    for line in f:
+                        self.add(line)
+            except OSError:
+                continue
+        if args.exclude:
+            for exclude in re.split(r"[,\s]+", args.exclude.strip()):
+                self.add_exclude(exclude)
+
+    def add(self, pattern):
+        """Appends a .gitignore-style pattern"""
+        rule = compile_ignore_pattern(pattern)
+        if rule is not None:
+            self.rules.append(rule)
+
+    def add_exclude(self, exclude):
+        """Appends an --exclude value. Paths like ./build or dir/build that
+        point inside the synced directory match just that path, anything
+        else is treated as a pattern"""
+        if not exclude:
+            return
+        path = os.path.abspath(exclude)
+        is_path = exclude.startswith(("./", "../")) or exclude in (".", "..")
+        if is_path or os.path.exists(exclude):
+            if path == self.root:
+                self.excludes_root = True
+                return
+            relpath = os.path.relpath(path, self.root)
+            if relpath.startswith(".."):
+                return  # outside the synced directory
+            exclude = "/" + relpath.replace(os.sep, "/")
+        self.add(exclude)
+
+    def ignored(self, relpath, is_dir):
+        """Whether relpath (relative to the synced dir, / separated) is ignored"""
+        name = relpath.rsplit("/", 1)[-1]
+        for rule in reversed(self.rules):
+            if rule.dir_only and not is_dir:
+                continue
+            if rule.regex.match(relpath if rule.anchored else name):
+                return not rule.negate
+        return False
+
+
+ignore_matchers = {}
+
+
+def ignore_matcher(local_path, args):
+    """Returns the IgnoreMatcher for local_path, compiling it on first use"""
+    key = (os.path.abspath(local_path), args.exclude)
+    matcher = ignore_matchers.get(key)
+    if matcher is None:
+        matcher = ignore_matchers[key] = IgnoreMatcher(local_path, args)
+    return matcher
+
+
+def walk_local_tree(local_path, args):
+    """Yields a LocalEntry for every directory and file under local_path that
+    should be synced, parents before their contents. One os.scandir pass per
+    directory supplies the type and stat data (symlinks are followed, like
+    the uploads do), the walk is iterative so deep trees cannot hit the
+    recursion limit, and ignored or already visited directories are pruned"""
+    matcher = ignore_matcher(local_path, args)
+    root = os.stat(local_path)
+    visited = {(root.st_dev, root.st_ino)}
+    pending = [(local_path, "")]
+    while pending:
+        dir_path, dir_relpath = pending.pop()
+        subdirs = []
+        with os.scandir(dir_path) as items:
+            for item in items:
+                item_relpath = (
+                    f"{dir_relpath}/{item.name}" if dir_relpath else item.name
+                )
+                try:
+                    is_dir = item.is_dir()
+                    if matcher.ignored(item_relpath, is_dir):
+                        if args.verbose:
+                            print(f"Ignoring: {item.path}")
+                        continue
+                    st = item.stat()
+                except OSError as e:  # e.g. a dangling symlink
+                    if args.verbose:
+                        print(f"Skipping {item.path}: {e.strerror}")
+                    continue
+                if is_dir:
+                    if (st.st_dev, st.st_ino) in visited:
+                        if args.verbose:
+                            print(f"Skipping symlink loop: {item.path}")
+                        continue
+                    visited.add((st.st_dev, st.st_ino))
+                    subdirs.append((item.path, item_relpath))
+                yield LocalEntry(
+                    item.path,
+                    item_relpath,
+                    is_dir,
+                    0 if is_dir else st.st_size,
+                    st.st_mtime_ns,
+                    st.st_mode,
+                    item.is_symlink(),
+                    st.st_ino,
+                )
+        pending.extend(reversed(subdirs))
+
+
+def collect_local_files(local_path, args):
+    """Returns the entries of walk_local_tree as a list"""
+    return list(walk_local_tree(local_path, args))
+
+
+class LocalScan:
+    """Walks the local tree on a background thread, started while the
+    connection is being set up, so the upload plan is ready by the time the
+    connection, authentication and SFTP setup have finished"""
+
+    def __init__(self):
+        self.local_path = None
+        self.thread = None
+        self.scanned = None
+        self.error = None
+
+    def start(self, local_path, args):
+        """Begins scanning local_path in the background"""
+        self.local_path = os.path.abspath(local_path)
+        self.thread = threading.Thread(
+            target=self.scan, args=(local_path, args), name="local scan", daemon=True
+        )
+        self.thread.start()
+
+    def scan(self, local_path, args):
+        """Collects the entries of local_path and checks them against the
+        upload guards"""
         try:
-            ignored_files = re.split(r"[,\s]+", args.exclude.strip())
-        except (KeyError, TypeError, ValueError):
-            return True
-    if base_name in IGNORE_DIRS or path in ignored_files:
-        return True
-    if any(base_name.startswith(prefix) for prefix in IGNORE_PREFIXES):
-        return True
+            with timings.span("local scan", path=local_path):
+                if should_ignore(local_path, args):
+                    self.scanned = ([], [], None)
+                    return
+                self.scanned = guard_entries(
+                    collect_local_files(local_path, args), args
+                )
+        except Exception as e:  # re-raised in the main thread by entries()
+            self.error = e
+
+    def result(self, local_path, args):
+        """Returns (entries, warnings, error) from guarding local_path,
+        waiting for the background scan if it covers that path, otherwise
+        walking it now"""
+        if self.thread is None or os.path.abspath(local_path) != self.local_path:
+            return guard_entries(collect_local_files(local_path, args), args)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.scanned
+
+    def entries(self, local_path, args):
+        """Returns the scanned entries of local_path that passed the guards,
+        after printing the guard warnings (and exiting if it is over the
+        limits)"""
+        entries, warnings, error = self.result(local_path, args)
+        report_guards(warnings, error)
+        return entries
+
+
+def report_guards(warnings, error):
+    """Prints the guard warnings, then exits if the upload is over the limits"""
+    for warning in warnings:
+        sys.stderr.write(f"{colorama.Fore.YELLOW}{warning}{colorama.Fore.RESET}\n")
+    if error:
+        sys.stderr.write(f"{colorama.Fore.RED}{error}{colorama.Fore.RESET}\n")
+        print_err_msg(Error.LIMITS)
+
+
+def parse_size(value):
+    """Parses a size like 512, 100K, 50M or 1.5G into bytes"""
+    value = value.strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def read_limits():
+    """Returns the upload guards from the [limits] section of config.ini,
+    falling back to GUARD_DEFAULTS. Raises ValueError for invalid values"""
+    config = read_config()
+    limits = dict(GUARD_DEFAULTS)
+    if config.has_section("limits"):
+        limits.update(config["limits"])
+    parsed = {
+        "max_file_size": parse_size(limits["max_file_size"]),
+        "max_total_size": parse_size(limits["max_total_size"]),
+        "max_files": int(limits["max_files"]),
+    }
+    for kind in ("executables", "archives"):
+        parsed[kind] = limits[kind].strip().lower()
+        if parsed[kind] not in ("skip", "warn", "allow"):
+            raise ValueError(f"{kind} must be skip, warn or allow")
+    return parsed
+
+
+def sniff_file_type(path):
+    """Returns "executable" or "archive" when the file starts with one of
+    their magic numbers, otherwise None"""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(262)
+            if is_executable(f, header):
+                return "executable"
+    except OSError:
+        return None
+    if header.startswith(ARCHIVE_MAGIC) or header[257:262] == b"ustar":
+        return "archive"
+    return None
+
+
+def is_executable(f, header):
+    """Whether header, the start of the open file f, belongs to a linked
+    ELF, Mach-O or PE binary or a core dump. Object files, Java classes and
+    text that happens to start with "MZ" are not executables"""
+    if header.startswith(b"\x7fELF") and len(header) >= 18:
+        byteorder = "big" if header[5] == 2 else "little"
+        return int.from_bytes(header[16:18], byteorder) in ELF_EXECUTABLE_TYPES
+    if header[:4] in MACHO_MAGIC and len(header) >= 16:
+        return int.from_bytes(header[12:16], MACHO_MAGIC[header[:4]]) != 1  # object
+    if header.startswith(b"\xca\xfe\xba\xbe") and len(header) >= 8:
+        # a fat Mach-O has its (small) architecture count here
+        return int.from_bytes(header[4:8], "big") < JAVA_MIN_MAJOR
+    if header.startswith(b"MZ") and len(header) >= 64:
+        f.seek(int.from_bytes(header[60:64], "little"))  # e_lfanew
+        return f.read(4) == b"PE\0\0"
     return False
 
 
-def sftp_recursive_put(sftp, local_path, remote_path, args):
-    """Recursively looks through directories to find files to sync"""
+def guard_entries(entries, args):
+    """Applies the upload guards to entries, returning the entries to upload,
+    warnings about skipped or suspicious files and an error when the upload
+    as a whole is over the limits. --no-guards turns every check off"""
+    if args.no_guards:
+        return entries, [], None
+    try:
+        limits = read_limits()
+    except ValueError as e:
+        return entries, [], f"Invalid [limits] setting: {e}"
+    kept = []
+    warnings = []
+    for entry in entries:
+        if entry.is_dir:
+            kept.append(entry)
+            continue
+        if entry.size > limits["max_file_size"]:
+            warnings.append(
+                f"Skipping {entry.relpath}: {format_size(entry.size)} is over "
+                f"max_file_size ({format_size(limits['max_file_size'])})"
+            )
+            continue
+        kind = sniff_file_type(entry.path) if entry.size else None
+        action = limits[f"{kind}s"] if kind else "allow"
+        if action == "skip":
+            warnings.append(f"Skipping {entry.relpath}: looks like an {kind}")
+            continue
+        if action == "warn":
+            warnings.append(f"Uploading {entry.relpath}, which looks like an {kind}")
+        kept.append(entry)
+
+    files = [entry for entry in kept if not entry.is_dir]
+    total = sum(entry.size for entry in files)
+    error = None
+    if len(files) > limits["max_files"]:
+        error = f"{len(files)} files is over max_files ({limits['max_files']})"
+    elif total > limits["max_total_size"]:
+        error = (
+            f"{format_size(total)} is over max_total_size "
+            f"({format_size(limits['max_total_size'])})"
+        )
+    return kept, warnings, error
+
+
+def sync_local_tree(sftp, ssh_client, local_path, remote_path, args):
+    """Uploads local_path to remote_path using the backend picked by --sync,
+    returning the entries it uploaded"""
+    if should_ignore(local_path, args):
+        if args.verbose:
+            print(f"Ignoring: {local_path}")
+        return []
+
+    if args.sync == "sftp":
+        return sftp_recursive_put(
+            sftp,
+            local_path=local_path,
+            remote_path=remote_path,
+            args=args,
+            ssh_client=ssh_client,
+        )
+    entries = local_scan.entries(local_path, args)
+    upload_entries(sftp, ssh_client, local_path, entries, remote_path, args)
+    return entries
+
+
+def upload_entries(sftp, ssh_client, local_path, entries, remote_path, args):
+    """Uploads a list of LocalEntry (from local_path) into remote_path,
+    with rsync or a tar stream when --sync picks them and otherwise putting
+    each file over SFTP"""
+    file_count = sum(1 for entry in entries if not entry.is_dir)
+    backend = sync_backend(file_count, args)
+    if args.verbose:
+        print(f"Syncing {file_count} files with {backend}")
+
+    if backend == "rsync":
+        try:
+            rsync_upload(ssh_client, local_path, entries, remote_path, args)
+            return
+        except (paramiko.SSHException, OSError) as e:
+            sys.stderr.write(
+                f"{colorama.Fore.YELLOW}rsync upload failed ({e}), falling back to "
+                + f"SFTP{colorama.Fore.RESET}\n"
+            )
+    if backend == "cas":
+        try:
+            cas_upload(ssh_client, local_path, entries, remote_path, args)
+            return
+        except (paramiko.SSHException, OSError) as e:
+            sys.stderr.write(
+                f"{colorama.Fore.YELLOW}Blob store upload failed ({e}), falling "
+                + f"back to SFTP{colorama.Fore.RESET}\n"
+            )
+    if backend == "tar":
+        try:
+            tar_upload(ssh_client, entries, remote_path, args)
+            return
+        except (paramiko.SSHException, OSError) as e:
+            sys.stderr.write(
+                f"{colorama.Fore.YELLOW}Tar upload failed ({e}), falling back to SFTP"
+                + f"{colorama.Fore.RESET}\n"
+            )
+
+    sftp_put_entries(sftp, ssh_client, entries, remote_path, args)
+
+
+def sync_backend(file_count, args):
+    """Returns the backend --sync picks for uploading file_count files"""
+    if args.sync == "auto":
+        return "tar" if file_count >= TAR_SYNC_THRESHOLD else "sftp"
+    return args.sync
+
+
+def print_sync_plan(local_path, entries, args, removed=()):
+    """Prints the files a sync would upload, the size of every directory,
+    the totals and a transfer time estimate from the last measured speed"""
+    files = sorted(
+        (entry for entry in entries if not entry.is_dir),
+        key=lambda entry: entry.relpath,
+    )
+    dir_sizes = {}
+    for entry in files:
+        parts = entry.relpath.split("/")[:-1]
+        for depth in range(len(parts) + 1):
+            totals = dir_sizes.setdefault("/".join(parts[:depth]), [0, 0])
+            totals[0] += 1
+            totals[1] += entry.size
+    total_bytes = sum(entry.size for entry in files)
+
+    print(f"Would upload from {local_path} with {sync_backend(len(files), args)}:")
+    for entry in files:
+        print(f"  {format_size(entry.size):>10}  {entry.relpath}")
+    for relpath in removed:
+        print(f"  {'delete':>10}  {relpath}")
+    if dir_sizes:
+        print("Per directory:")
+        for relpath in sorted(dir_sizes):
+            count, size = dir_sizes[relpath]
+            name = f"{relpath}/" if relpath else "./"
+            print(f"  {format_size(size):>10}  {name} ({count} files)")
+
+    summary = f"Total: {len(files)} files, {format_size(total_bytes)}"
+    throughput = load_throughput()
+    if throughput and files:
+        # bytes at the measured bandwidth plus the measured per-file overhead
+        estimate = 0.0
+        if "bytes_per_s" in throughput:
+            estimate += total_bytes / throughput["bytes_per_s"]
+        if "files_per_s" in throughput:
+            estimate += len(files) / throughput["files_per_s"]
+        summary += f", about {estimate:.1f}s going by the last uploads"
+    elif files:
+        summary += ", no upload measured yet to estimate the time"
+    print(summary)
+
+
+def throughput_path():
+    """Returns where the last measured upload throughput is kept"""
+    return os.path.join(platformdirs.user_cache_dir("zse"), THROUGHPUT_FILE)
+
+
+def save_throughput(elapsed):
+    """Stores the speed of the upload that just finished, for --dry-run.
+    Uploads of at least THROUGHPUT_MIN_BYTES measure the bandwidth, smaller
+    ones are dominated by round trips and measure the per-file rate"""
+    files, nbytes = timings.transfers.get("uploaded", (0, 0))
+    if not files or elapsed <= 0:
+        return
+    throughput = load_throughput() or {}
+    if nbytes >= THROUGHPUT_MIN_BYTES:
+        throughput["bytes_per_s"] = nbytes / elapsed
+    else:
+        throughput["files_per_s"] = files / elapsed
+    try:
+        os.makedirs(os.path.dirname(throughput_path()), exist_ok=True)
+        with open(throughput_path(), "w", encoding="utf-8") as f:
+            json.dump(throughput, f)
+    except OSError:
+        pass
+
+
+def load_throughput():
+    """Returns the last measured upload rates, or None"""
+    try:
+        with open(throughput_path(), encoding="utf-8") as f:
+            throughput = json.load(f)
+        throughput = {
+            key: value
+            for key, value in throughput.items()
+            if key in ("bytes_per_s", "files_per_s") and value > 0
+        }
+        return throughput or None
+    except (OSError, ValueError, AttributeError, TypeError):
+        return None
+
+
+def sticky_workspace(local_path):
+    """Returns the persistent remote workspace used by --sticky for local_path"""
+    local_path = os.path.abspath(local_path)
+    key = f"{socket.gethostname()}:{local_path}".encode()
+    digest = hashlib.sha256(key).hexdigest()[:12]
+    name = re.sub(r"[^\w.-]", "_", os.path.basename(local_path)) or "root"
+    return f"{WORKSPACE_DIR}/{name}-{digest}"
+
+
+def hash_file(path):
+    """Returns the sha256 hex digest of a local file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashIndex:
+    """On-disk index of the file hashes under one local root, for one remote
+    host. Files are keyed by relpath -> (inode, size, mtime_ns, hash), so
+    --sync cas never reads an unchanged file twice to name its blob"""
+
+    def __init__(self, local_path):
+        server = read_config()
+        host = server.get("server", "address", fallback="")
+        user = server.get("server", "username", fallback="")
+        self.key = f"{user}@{host}:{os.path.abspath(local_path)}"
+        root = load_hash_index().get(self.key, {})
+        self.files = root.get("files", {})
+        self.lock = threading.Lock()
+
+    def digest(self, entry):
+        """Returns the sha256 of a file LocalEntry, hashing it only when its
+        inode, size or mtime changed since it was last hashed"""
+        cached = self.files.get(entry.relpath)
+        if cached and cached[:3] == [entry.inode, entry.size, entry.mtime_ns]:
+            return cached[3]
+        digest = hash_file(entry.path)
+        with self.lock:
+            self.files[entry.relpath] = [
+                entry.inode,
+                entry.size,
+                entry.mtime_ns,
+                digest,
+            ]
+        return digest
+
+    def save(self, entries=None):
+        """Writes the index back, dropping files missing from entries (the
+        full scan, when given) and stale roots"""
+        if entries is not None:
+            present = {entry.relpath for entry in entries}
+            self.files = {
+                relpath: value
+                for relpath, value in self.files.items()
+                if relpath in present
+            }
+
+        now = time.time()
+        roots = load_hash_index()  # re-read, another zse may have saved since
+        roots[self.key] = {"used": now, "files": self.files}
+        roots = {
+            key: {"used": root.get("used", 0), "files": root.get("files", {})}
+            for key, root in roots.items()
+            if now - root.get("used", 0) < HASH_INDEX_MAX_AGE
+        }
+        total = sum(len(root.get("files", {})) for root in roots.values())
+        for key in sorted(roots, key=lambda key: roots[key].get("used", 0)):
+            if total <= HASH_INDEX_MAX_FILES or key == self.key:
+                break
+            total -= len(roots.pop(key).get("files", {}))
+
+        path = hash_index_path()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(roots, f, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+
+hash_indexes = {}
+
+
+def hash_index(local_path):
+    """Returns the HashIndex for local_path, loading it on first use"""
+    key = os.path.abspath(local_path)
+    index = hash_indexes.get(key)
+    if index is None:
+        index = hash_indexes[key] = HashIndex(local_path)
+    return index
+
+
+def hash_index_path():
+    """Returns where the file hash index is kept"""
+    return os.path.join(platformdirs.user_cache_dir("zse"), HASH_INDEX_FILE)
+
+
+def load_hash_index():
+    """Returns every root in the hash index, or {} if it is missing or bad"""
+    try:
+        with open(hash_index_path(), encoding="utf-8") as f:
+            roots = json.load(f)
+        return roots if isinstance(roots, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def read_manifest(sftp, manifest_path):
+    """Reads a workspace manifest, returning an empty one if it is missing"""
+    try:
+        with sftp.open(manifest_path, "r") as f:
+            return json.loads(f.read().decode())
+    except (IOError, ValueError):
+        return {"files": {}, "dirs": []}
+
+
+def write_manifest(sftp, manifest_path, manifest):
+    """Atomically replaces a workspace manifest"""
+    tmp_path = f"{manifest_path}.tmp"
+    with sftp.open(tmp_path, "w") as f:
+        f.write(json.dumps(manifest, separators=(",", ":")))
+    sftp.posix_rename(tmp_path, manifest_path)
+
+
+def sticky_sync(sftp, ssh_client, local_path, remote_path, args, entries=None):
+    """Syncs local_path (or its already scanned entries) into a persistent
+    workspace, returning the entries. The manifest kept next to the
+    workspace maps path -> (size, mtime, hash), so only added or changed
+    files are uploaded and files deleted locally are removed remotely"""
+    if should_ignore(local_path, args):
+        if args.verbose:
+            print(f"Ignoring: {local_path}")
+        return []
+
+    if entries is None:
+        entries = local_scan.entries(local_path, args)
+    to_upload, removed, manifest, changed = sticky_plan(
+        sftp, ssh_client, local_path, remote_path, args, entries
+    )
+    files = manifest["files"]
+    if args.verbose:
+        print(
+            f"Workspace {remote_path}: {len(to_upload)} new/changed, "
+            f"{len(removed)} removed, {len(files)} files total"
+        )
+    if removed:
+        remove_remote_paths(ssh_client, remote_path, removed, args)
+    for entry in [entry for entry in to_upload if entry.relpath in changed]:
+        if entry.size < DELTA_THRESHOLD:
+            continue
+        if delta_upload(ssh_client, entry, f"{remote_path}/{entry.relpath}", args):
+            to_upload.remove(entry)
+    if to_upload:
+        upload_entries(sftp, ssh_client, local_path, to_upload, remote_path, args)
+    write_manifest(sftp, f"{remote_path}.json", manifest)
+    return entries
+
+
+def workspace_state(ssh_client, remote_path):
+    """Lists the workspace with one `find -printf`, returning the mtime of
+    its manifest and relpath -> (type, size, mtime) for everything in it, or
+    None when the remote find cannot do this"""
+    manifest_path = f"{remote_path}.json"
+    command = (
+        f"find {shlex.quote(manifest_path)} {shlex.quote(remote_path)} "
+        "-printf '%y %s %T@ %p\\0'"
+    )
+    _stdin, stdout, _stderr = traced_exec(ssh_client, command)
+    output = stdout.read()
+    stdout.channel.recv_exit_status()  # non-zero if the workspace is missing
+    try:
+        records = [
+            record.decode().split(" ", 3) for record in output.split(b"\0") if record
+        ]
+    except UnicodeDecodeError:
+        return None
+
+    manifest_mtime = None
+    state = {}
+    prefix = f"{remote_path}/"
+    for kind, size, mtime, path in records:
+        if path == manifest_path:
+            manifest_mtime = float(mtime)
+        elif path.startswith(prefix):
+            state[path[len(prefix) :]] = (kind, int(size), float(mtime))
+    return None if manifest_mtime is None else (manifest_mtime, state)
+
+
+def stale_workspace_paths(ssh_client, remote_path, old_files, old_dirs):
+    """Checks the workspace against its manifest, returning the relpaths
+    whose remote copy is gone and those modified after the manifest was
+    written (by a command run in the workspace, or by hand)"""
+    missing, edited = set(), set()
+    listed = workspace_state(ssh_client, remote_path)
+    if listed is None:
+        return missing, edited
+    manifest_mtime, state = listed
+
+    missing.update(relpath for relpath in old_dirs if relpath not in state)
+    for relpath, (size, mtime_ns, _digest) in old_files.items():
+        remote = state.get(relpath)
+        if remote is None:
+            missing.add(relpath)
+            continue
+        kind, remote_size, remote_mtime = remote
+        if kind == "f" and remote_size != size:
+            edited.add(relpath)
+        # Uploads keep the local mtime or predate the manifest, so only a
+        # newer mtime that is not the local one means a remote edit
+        elif remote_mtime > manifest_mtime and abs(remote_mtime - mtime_ns / 1e9) >= 1:
+            edited.add(relpath)
+    return missing, edited
+
+
+def sticky_plan(sftp, ssh_client, local_path, remote_path, args, entries=None):
+    """Diffs local_path (or its already scanned entries) against the
+    workspace manifest, returning the entries to upload, the relpaths to
+    delete remotely, the new manifest and the relpaths of the files to upload
+    that already have a remote copy. Manifest entries whose remote copy was
+    deleted or edited since are planned for upload again"""
+    old_manifest = read_manifest(sftp, f"{remote_path}.json")
+    old_files = old_manifest.get("files", {})
+    old_dirs = set(old_manifest.get("dirs", []))
+    if old_files or old_dirs:
+        missing, edited = stale_workspace_paths(
+            ssh_client, remote_path, old_files, old_dirs
+        )
+        if args.verbose and (missing or edited):
+            print(
+                f"Workspace {remote_path}: {len(missing)} missing, "
+                f"{len(edited)} changed remotely"
+            )
+        old_files = {
+            relpath: [-1, -1, None] if relpath in edited else value
+            for relpath, value in old_files.items()
+            if relpath not in missing
+        }
+        old_dirs -= missing
+
+    if entries is None:
+        entries = local_scan.entries(local_path, args)
+    files = {}
+    to_upload = []
+    changed = set()
+    for entry in entries:
+        if entry.is_dir:
+            if entry.relpath not in old_dirs:
+                to_upload.append(entry)
+            continue
+        previous = old_files.get(entry.relpath)
+        if previous and previous[:2] == [entry.size, entry.mtime_ns]:
+            digest = previous[2]
+        else:
+            digest = hash_file(entry.path)
+            if not previous or previous[2] != digest:
+                to_upload.append(entry)
+            if previous and previous[2] != digest:
+                changed.add(entry.relpath)
+        files[entry.relpath] = [entry.size, entry.mtime_ns, digest]
+    dirs = [entry.relpath for entry in entries if entry.is_dir]
+
+    removed = sorted(set(old_files) - set(files)) + sorted(old_dirs - set(dirs))
+    return to_upload, removed, {"files": files, "dirs": dirs}, changed
+
+
+def sticky_dry_run(sftp, ssh_client, local_path, remote_path, args):
+    """Prints the plan a --sticky sync would carry out, without changing the
+    workspace"""
+    if should_ignore(local_path, args):
+        print_sync_plan(local_path, [], args)
+        return
+    entries, warnings, error = local_scan.result(local_path, args)
+    to_upload, removed, _manifest, _changed = sticky_plan(
+        sftp, ssh_client, local_path, remote_path, args, entries
+    )
+    print_sync_plan(local_path, to_upload, args, removed)
+    report_guards(warnings, error)
+
+
+def delta_block_size(size):
+    """Returns the delta block size for a file of size bytes: about its
+    square root, like rsync, in whole KiB between 4 KiB and 128 KiB"""
+    return min(max(int(size**0.5) // 1024 * 1024, 4096), 128 * 1024)
+
+
+def compute_delta(data, signatures, block_size):
+    """Matches data against the remote block signatures with a rolling
+    adler32, returning ("copy", first block, count) and ("literal", start,
+    end) ops that rebuild data, or None when over DELTA_MAX_LITERAL of it
+    would have to be sent anyway or the first DELTA_PROBE_BLOCKS match
+    nothing. Once DELTA_MAX_SCAN of it went unmatched, only offsets a whole
+    block apart are tried, bounding the slow byte-by-byte search"""
+    blocks = {}
+    for index, (weak, strong) in enumerate(signatures):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    ops = []
+    literal_start = literal_bytes = pos = 0
+    budget = DELTA_MAX_LITERAL * len(data)
+    scan_budget = DELTA_MAX_SCAN * len(data)
+    weak = None
+    while pos + block_size <= len(data):
+        if weak is None:
+            weak = zlib.adler32(data[pos : pos + block_size])
+        candidates = blocks.get(weak)
+        if candidates:
+            block = data[pos : pos + block_size]
+            index = candidates.get(hashlib.blake2b(block, digest_size=16).digest())
+            if index is not None:
+                if literal_start < pos:
+                    ops.append(("literal", literal_start, pos))
+                if ops and ops[-1][0] == "copy" and sum(ops[-1][1:]) == index:
+                    ops[-1] = ("copy", ops[-1][1], ops[-1][2] + 1)
+                else:
+                    ops.append(("copy", index, 1))
+                pos += block_size
+                literal_start = pos
+                weak = None
+                continue
+        if pos + block_size == len(data):
+            break
+        if literal_bytes > scan_budget:
+            # to the next block boundary after the last match, where blocks
+            # that were edited in place line up with the remote ones again
+            step = block_size - (pos - literal_start) % block_size
+            step = min(step, len(data) - block_size - pos)
+            pos += step
+            literal_bytes += step
+            weak = None
+        else:
+            # slide the window one byte, adler32's sums can be updated in place
+            out_byte, in_byte = data[pos], data[pos + block_size]
+            a = ((weak & 0xFFFF) - out_byte + in_byte) % 65521
+            b = ((weak >> 16) - block_size * out_byte + a - 1) % 65521
+            weak = (b << 16) | a
+            pos += 1
+            literal_bytes += 1
+        if literal_bytes > budget:
+            return None
+        if not ops and literal_bytes > DELTA_PROBE_BLOCKS * block_size:
+            return None  # nothing in common near the start, likely rewritten
+    if literal_start < len(data):
+        ops.append(("literal", literal_start, len(data)))
+    return ops
+
+
+def delta_upload(ssh_client, entry, remote_file, args):
+    """Updates remote_file to match entry by sending only the blocks that
+    changed, using a python3 helper on the remote to list block signatures
+    and rebuild the file. Returns False if the file has to be sent whole"""
+    block_size = delta_block_size(entry.size)
+    helper = f"python3 -c {shlex.quote(DELTA_HELPER)}"
+    target = f"{shlex.quote(remote_file)} {block_size}"
+    with timings.span("delta", path=entry.relpath):
+        _stdin, stdout, _stderr = traced_exec(
+            ssh_client, f"{helper} signature {target}"
+        )
+        raw = stdout.read()
+        if stdout.channel.recv_exit_status() != 0:
+            return False
+        signatures = [
+            struct.unpack("!I16s", raw[i : i + 20]) for i in range(0, len(raw), 20)
+        ]
+        with open(entry.path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            ops = compute_delta(data, signatures, block_size)
+            if ops is None:
+                return False
+            _stdin, stdout, stderr = traced_exec(ssh_client, f"{helper} patch {target}")
+            chan = stdout.channel
+            stream = ChannelWriter(chan)
+            try:
+                for op, first, last in ops:
+                    if op == "copy":
+                        stream.write(b"C" + struct.pack("!QI", first, last))
+                        continue
+                    for start in range(first, last, READ_SIZE_MAX):
+                        chunk = data[start : min(start + READ_SIZE_MAX, last)]
+                        stream.write(b"L" + struct.pack("!I", len(chunk)) + chunk)
+                stream.write(b"E" + hashlib.sha256(data).digest())
+            finally:
+                chan.shutdown_write()
+        if chan.recv_exit_status() != 0:
+            if args.verbose:
+                message = stderr.read().decode(errors="replace").strip()
+                print(f"Delta for {entry.relpath} failed: {message}")
+            return False
+    timings.add_transfer("uploaded", 0)
+    if args.verbose:
+        sent = sum(last - first for op, first, last in ops if op == "literal")
+        print(
+            f"Sent {entry.relpath} as a delta: {format_size(sent)} of "
+            f"{format_size(entry.size)} changed"
+        )
+    return True
+
+
+def remove_remote_paths(ssh_client, remote_path, relpaths, args):
+    """Deletes paths relative to remote_path, batching them into few commands"""
+    batch_size = 200
+    for start in range(0, len(relpaths), batch_size):
+        batch = relpaths[start : start + batch_size]
+        if args.verbose:
+            for relpath in batch:
+                print(f"Deleting remote path: {remote_path}/{relpath}")
+        command = f"cd {shlex.quote(remote_path)} && rm -rf -- " + " ".join(
+            shlex.quote(relpath) for relpath in batch
+        )
+        _stdin, stdout, _stderr = traced_exec(ssh_client, command)
+        stdout.channel.recv_exit_status()
+
+
+def tar_upload(ssh_client, entries, remote_path, args, then=None):
+    """Streams entries as a tar archive over one exec channel into `tar x`
+    inside remote_path, instead of one SFTP round trip per file. then is a
+    shell snippet run in remote_path once the archive is extracted"""
+    extract = "tar -xf -"
+    mode = "w|"
+    if args.compress == "gzip":
+        extract = "tar -xzf -"
+        mode = "w|gz"
+    elif args.compress == "zstd":
+        extract = "zstd -dcq | tar -xf -"
+
+    command = f"cd {shlex.quote(remote_path)} && {extract}"
+    if then:
+        command += f" && {then}"
+    _stdin, stdout, stderr = traced_exec(ssh_client, command)
+    chan = stdout.channel
+    stream = ChannelWriter(chan)
+    if args.compress == "zstd":
+        try:
+            import zstandard  # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            chan.close()
+            raise OSError("zstd compression needs the zstandard package") from e
+        stream = zstandard.ZstdCompressor().stream_writer(stream, closefd=False)
+
+    files = [entry for entry in entries if not entry.is_dir]
+    progress = Progress("Uploading", len(files), sum(entry.size for entry in files))
+    try:
+        with timings.span("tar stream", files=len(entries)), tarfile.open(
+            fileobj=stream, mode=mode, dereference=True
+        ) as tar:
+            for entry in entries:
+                if args.verbose:
+                    print(f"Adding to tar stream: {entry.path}")
+                tar.add(entry.path, arcname=entry.relpath, recursive=False)
+                if not entry.is_dir:
+                    timings.add_transfer("uploaded", 0)
+                    progress.file_done(entry.size)
+        if args.compress == "zstd":
+            stream.close()
+    finally:
+        chan.shutdown_write()
+        progress.finish()
+
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        message = stderr.read().decode(errors="replace").strip()
+        raise paramiko.SSHException(f"remote tar exited with {exit_status}: {message}")
+
+
+def cas_object(entry, digest):
+    """Returns the blob store name of a file, executables are kept apart so
+    every hardlink gets the right mode"""
+    suffix = "x" if entry.mode & 0o111 else ""
+    return f"{digest[:2]}/{digest[2:]}{suffix}"
+
+
+def cas_upload(ssh_client, local_path, entries, remote_path, args):
+    """Uploads entries through the remote blob store in two round trips: one
+    collects old blobs now and then and asks which blobs are missing, the
+    other streams just those blobs as a tar and hardlinks every file into
+    remote_path. If linking fails, the files already linked are removed
+    again, so the SFTP fallback is not left facing read-only hardlinks"""
+    index = hash_index(local_path)
+    files = [entry for entry in entries if not entry.is_dir]
+    with timings.span("hash", files=len(files)):
+        objects = {
+            entry.relpath: cas_object(entry, index.digest(entry)) for entry in files
+        }
+    # prune against the whole scan, entries may be just the changed files
+    index.save(local_scan.result(local_path, args)[0])
+
+    incoming = f"incoming-{secrets.token_hex(8)}"
+    objects_dir = shlex.quote(OBJECTS_DIR)
+    # the collection has to come first, a blob reported present must still
+    # be there when the link step runs
+    query = (
+        f"mkdir -p {objects_dir}/{incoming} && cd {objects_dir} && "
+        f'if [ -z "$(find .gc -mtime -{CAS_GC_INTERVAL} 2>/dev/null)" ]; then '
+        "touch .gc; "
+        f"find . -path './??/*' -type f -links 1 -ctime +{CAS_GC_DAYS} -delete; "
+        "find . -maxdepth 1 -name 'incoming-*' -mtime +1 -exec rm -rf {} +; "
+        "fi >/dev/null 2>&1; "
+        'while IFS= read -r name; do [ -e "$name" ] || echo "$name"; done'
+    )
+    stdin, stdout, stderr = traced_exec(ssh_client, query)
+    stdin.write("".join(f"{name}\n" for name in set(objects.values())))
+    stdin.channel.shutdown_write()
+    missing = set(stdout.read().decode().split())
+    if stdout.channel.recv_exit_status() != 0:
+        message = stderr.read().decode(errors="replace").strip()
+        raise paramiko.SSHException(f"could not query {OBJECTS_DIR}: {message}")
+    if args.verbose:
+        print(
+            f"{len(set(objects.values())) - len(missing)} of "
+            f"{len(set(objects.values()))} blobs already in {OBJECTS_DIR}"
+        )
+
+    blobs = {}
+    for entry in files:
+        name = objects[entry.relpath]
+        if name in missing and name not in blobs:
+            blobs[name] = entry._replace(relpath=name)
+    with tempfile.TemporaryDirectory(prefix="zse-cas-") as tmp:
+        manifest_path = os.path.join(tmp, "manifest")
+        with open(manifest_path, "w", encoding="utf-8", newline="\n") as f:
+            for entry in entries:
+                name = "/" if entry.is_dir else objects[entry.relpath]
+                f.write(f"{name}\n{entry.relpath}\n")
+        st = os.stat(manifest_path)
+        manifest = LocalEntry(
+            manifest_path,
+            "manifest",
+            False,
+            st.st_size,
+            st.st_mtime_ns,
+            st.st_mode,
+            False,
+            st.st_ino,
+        )
+        try:
+            tar_upload(
+                ssh_client,
+                [*blobs.values(), manifest],
+                f"{OBJECTS_DIR}/{incoming}",
+                args,
+                then=shlex.join(["sh", "-c", CAS_LINK_SCRIPT, "sh", remote_path]),
+            )
+        except (paramiko.SSHException, OSError):
+            with contextlib.suppress(paramiko.SSHException, OSError):
+                remove_remote_paths(
+                    ssh_client, remote_path, [entry.relpath for entry in files], args
+                )
+            raise
+
+
+def rsync_upload(ssh_client, local_path, entries, remote_path, args):
+    """Runs the local rsync with zse itself as its remote shell, so rsync's
+    delta transfer goes over the connection zse already authenticated. The
+    entries are passed with --files-from, so the ignore rules still apply.
+    Raises OSError when either end has no rsync"""
+    if not shutil.which("rsync") or not hasattr(socket, "AF_UNIX"):
+        raise OSError("rsync is not installed locally")
+    _stdin, stdout, _stderr = traced_exec(ssh_client, "command -v rsync")
+    if stdout.channel.recv_exit_status() != 0:
+        raise OSError("rsync is not installed on the remote")
+
+    if getattr(sys, "frozen", False):  # PyInstaller build, the exe is zse
+        relay = [sys.executable, RSYNC_RELAY]
+    else:
+        relay = [sys.executable, os.path.abspath(__file__), RSYNC_RELAY]
+    # -L follows symlinks like the tar and SFTP uploads, --files-from
+    # implies --dirs so listed directories are created but not recursed
+    command = ["rsync", "-Lt", "--files-from=-", "--from0"]
+    command += ["-e", shlex.join(relay)]
+    if args.compress:
+        command.append("-z")
+    if args.verbose:
+        command.append("-v")
+    command += [os.path.join(local_path, ""), f"zse:{remote_path}/"]
+
+    files = [entry for entry in entries if not entry.is_dir]
+    with tempfile.TemporaryDirectory(prefix="zse-rsync-") as tmp:
+        path = os.path.join(tmp, "relay.sock")
+        with socket.socket(socket.AF_UNIX) as listener:
+            listener.bind(path)
+            listener.listen(1)
+            threading.Thread(
+                target=serve_rsync_relay,
+                args=(listener, ssh_client),
+                name="rsync relay",
+                daemon=True,
+            ).start()
+            with timings.span("rsync", files=len(files)):
+                result = subprocess.run(
+                    command,
+                    input=b"\0".join(entry.relpath.encode() for entry in entries),
+                    env=dict(os.environ, **{RSYNC_SOCKET_ENV: path}),
+                    stdout=None if args.verbose else subprocess.DEVNULL,
+                    check=False,
+                )
+    if result.returncode != 0:
+        raise OSError(f"rsync exited with {result.returncode}")
+    timings.add_transfer(
+        "uploaded", sum(entry.size for entry in files), files=len(files)
+    )
+
+
+def serve_rsync_relay(listener, ssh_client):
+    """Accepts the relay started by rsync, runs the remote rsync command it
+    sends and copies bytes both ways until the remote side exits"""
+    try:
+        conn, _ = listener.accept()
+    except OSError:
+        return
+    with conn:
+        kind, payload = recv_frame(conn)
+        if kind != b"R":
+            return
+        _stdin, stdout, _stderr = traced_exec(ssh_client, payload.decode())
+        chan = stdout.channel
+        sel = selectors.DefaultSelector()
+        sel.register(conn, selectors.EVENT_READ, "relay")
+        sel.register(chan, selectors.EVENT_READ, "chan")
+        try:
+            while True:
+                for key, _ in sel.select(timeout=1):
+                    if key.data == "relay":
+                        data = conn.recv(65536)
+                        if data:
+                            chan.sendall(data)
+                        else:  # rsync is done sending
+                            sel.unregister(conn)
+                            chan.shutdown_write()
+                while chan.recv_stderr_ready():
+                    sys.stderr.buffer.write(chan.recv_stderr(65536))
+                    sys.stderr.flush()
+                while chan.recv_ready():
+                    conn.sendall(chan.recv(65536))
+                if chan.exit_status_ready() and not (
+                    chan.recv_ready() or chan.recv_stderr_ready()
+                ):
+                    break
+        except OSError:
+            pass
+        finally:
+            sel.close()
+            chan.close()
+
+
+def rsync_relay(argv):
+    """Runs as rsync's remote shell, called as `zse --rsync-relay HOST CMD..`.
+    Hands CMD to the zse process that started rsync over its socket, then
+    relays stdin/stdout through it"""
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(os.environ[RSYNC_SOCKET_ENV])
+        send_frame(sock, b"R", shlex.join(argv[1:]).encode())
+        sel = selectors.DefaultSelector()
+        sel.register(sys.stdin.fileno(), selectors.EVENT_READ, "stdin")
+        sel.register(sock, selectors.EVENT_READ, "sock")
+        while True:
+            for key, _ in sel.select():
+                if key.data == "stdin":
+                    data = os.read(sys.stdin.fileno(), 65536)
+                    if data:
+                        sock.sendall(data)
+                    else:
+                        sel.unregister(sys.stdin.fileno())
+                        sock.shutdown(socket.SHUT_WR)
+                    continue
+                data = sock.recv(65536)
+                if not data:
+                    return 0
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(sys.stdout.fileno(), view) :]
+
+
+class ChannelWriter:
+    """Write-only file object that sends straight to a channel"""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def write(self, data):
+        """Sends data to the remote command's stdin"""
+        self.channel.sendall(data)
+        timings.add_transfer("uploaded", len(data), files=0)
+        return len(data)
+
+
+def sftp_recursive_put(sftp, local_path, remote_path, args, ssh_client=None):
+    """Recursively looks through directories to find files to sync,
+    returning the entries of a directory it uploaded"""
     try:
         if should_ignore(local_path, args):
             if args.verbose:
                 print(f"Ignoring: {local_path}")
-            return
+            return []
 
         if os.path.isdir(local_path):
             try:
@@ -526,67 +2597,669 @@ def sftp_recursive_put(sftp, local_path, remote_path, args):
                     print(f"Creating remote directory: {remote_path}")
                 sftp.mkdir(remote_path)
 
-            for item in os.listdir(local_path):
-                sftp_recursive_put(
-                    sftp,
-                    os.path.join(local_path, item),
-                    f"{remote_path}/{item}".replace("\\", "/"),
-                    args,
-                )
-        else:
-            loading_symbols = ["⠋", "⠙", "⠸", "⠴", "⠦", "⠇"]
-            for i in range(len(loading_symbols) * 3):
-                terminal_length = shutil.get_terminal_size().columns
-                print(
-                    f"\r\033[KSyncing file: "
-                    f"{loading_symbols[i % len(loading_symbols)]} "
-                    f"{local_path} -> "
-                    f"{remote_path}"[:terminal_length],
-                    flush=True,
-                    end="",
-                )
-            print(
-                f"\r\033[KTransferring file: {local_path} -> {remote_path}"[
-                    :terminal_length
-                ],
-                flush=True,
-                end="",
+            entries = local_scan.entries(local_path, args)
+            sftp_put_entries(sftp, ssh_client, entries, remote_path, args)
+            return entries
+        progress = Progress("Uploading", 1, os.path.getsize(local_path))
+        try:
+            sftp_put_file(sftp, local_path, remote_path, progress)
+        finally:
+            progress.finish()
+        return []
+    except KeyboardInterrupt:
+        print(
+            colorama.Fore.RED
+            + "\nConnection closed by user."
+            + colorama.Style.RESET_ALL
+        )
+        sys.exit(0)
+
+
+def sftp_put_entries(sftp, ssh_client, entries, remote_path, args):
+    """Creates the directories in entries, then uploads the files over the
+    --jobs SFTP worker pool. Files in a workspace that outlives the upload
+    (--sticky, --watch) replace what is there instead of overwriting it"""
+    try:
+        files = []
+        for entry in entries:
+            remote_item_path = f"{remote_path}/{entry.relpath}"
+            if entry.is_dir:
+                try:
+                    sftp.stat(remote_item_path)
+                except FileNotFoundError:
+                    if args.verbose:
+                        print(f"Creating remote directory: {remote_item_path}")
+                    sftp.mkdir(remote_item_path)
+            else:
+                files.append(entry)
+        progress = Progress("Uploading", len(files), sum(entry.size for entry in files))
+        replace = args.sticky or args.watch
+        jobs = [
+            lambda client, job=(entry.path, f"{remote_path}/{entry.relpath}"): (
+                sftp_put_file(client, *job, progress, replace)
             )
-            sftp.put(local_path, remote_path)
+            for entry in files
+        ]
+        try:
+            run_sftp_jobs(ssh_client, sftp, jobs, args)
+        finally:
+            progress.finish()
     except KeyboardInterrupt:
-        print(Fore.RED + "\nConnection closed by user." + Style.RESET_ALL)
+        print(
+            colorama.Fore.RED
+            + "\nConnection closed by user."
+            + colorama.Style.RESET_ALL
+        )
         sys.exit(0)
 
 
+def sftp_put_file(sftp, local_path, remote_path, progress=None, replace=False):
+    """Uploads a single file, reporting its bytes to progress as they are
+    sent. With replace, the file is written under a temporary name and
+    renamed over remote_path, so a file already there (possibly a read-only
+    --sync cas hardlink into the blob store) is swapped out, never written
+    through"""
+    callback = progress.callback() if progress else None
+    target = f"{remote_path}.zse-tmp" if replace else remote_path
+    with timings.span("sftp.put", path=local_path):
+        attrs = sftp.put(local_path, target, callback=callback)
+    if replace:
+        sftp.posix_rename(target, remote_path)
+    timings.add_transfer("uploaded", attrs.st_size or 0)
+    if progress:
+        progress.file_done()
+
+
+def manage_daemon(args):
+    """Handles the --daemon start/stop/status actions, returning an exit code"""
+    config = read_config()
+    try:
+        server_info = config["server"]
+    except KeyError:
+        print_err_msg(Error.AUTH)
+    client = DaemonClient(daemon_socket_path())
+
+    if args.daemon == "start":
+        if client.matches(server_info):
+            print("zse daemon is already running")
+            return 0
+        return 0 if start_daemon(config, args) else 1
+
+    if args.daemon == "stop":
+        try:
+            client.request(kind="stop")[0].close()
+        except (OSError, paramiko.SSHException):
+            print("zse daemon is not running")
+            return 1
+        print("zse daemon stopped")
+        return 0
+
+    identity = client.ping()
+    if identity is None:
+        print("zse daemon is not running")
+        return 1
+    print(
+        f"zse daemon (pid {identity['pid']}) connected to "
+        f"{identity['username']}@{identity['address']}:{identity['port']}"
+    )
+    return 0
+
+
+def daemon_socket_path():
+    """Returns the path of the local socket the zse daemon listens on"""
+    cache_dir = platformdirs.user_cache_dir("zse")
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    return os.path.join(cache_dir, DAEMON_SOCKET)
+
+
+def daemon_connect(config, args):
+    """Returns a client for a running daemon that matches the config, if any.
+    Starts one first when [daemon] autostart is enabled."""
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    client = DaemonClient(daemon_socket_path())
+    if client.matches(config["server"]):
+        if args.verbose:
+            print("Using connection held by zse daemon")
+        return client
+    if config.getboolean("daemon", "autostart", fallback=False):
+        if start_daemon(config, args) and client.matches(config["server"]):
+            return client
+    return None
+
+
+def start_daemon(config, args):
+    """Forks a background zse daemon that holds an authenticated connection"""
+    if not hasattr(os, "fork") or not hasattr(socket, "AF_UNIX"):
+        sys.stderr.write("zse daemon is not supported on this platform\n")
+        return False
+
+    server_info = config["server"]
+    auth_info = config["auth"]
+    idle_timeout = config.getint("daemon", "idle_timeout", fallback=DAEMON_IDLE_TIMEOUT)
+    try:
+        password = get_password(auth_info)
+    except KeyboardInterrupt:
+        return False
+    path = daemon_socket_path()
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        try:
+            daemon = ZseDaemon(server_info, auth_info, password, idle_timeout)
+            daemon.serve_forever(path, write_fd)
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as ready:
+        message = ready.read().decode(errors="replace")
+    if message != "ok":
+        sys.stderr.write(
+            f"{colorama.Fore.RED}zse daemon failed to start: {message}{colorama.Fore.RESET}\n"
+        )
+        return False
+    if args.verbose:
+        print(f"Started zse daemon (pid {pid}) on {path}")
+    return True
+
+
+def send_frame(sock, kind, payload=b""):
+    """Writes one length-prefixed frame to a daemon socket"""
+    sock.sendall(kind + struct.pack("!I", len(payload)) + payload)
+
+
+def recv_exact(sock, size):
+    """Reads exactly size bytes from a socket, returning None on EOF"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock):
+    """Reads one frame from a daemon socket, returning (None, b"") on EOF"""
+    header = recv_exact(sock, 5)
+    if header is None:
+        return None, b""
+    (size,) = struct.unpack("!I", header[1:])
+    payload = recv_exact(sock, size) if size else b""
+    if payload is None:
+        return None, b""
+    return header[:1], payload
+
+
+class ZseDaemon:
+    """Background agent that holds an authenticated paramiko transport and
+    relays channels for later zse runs over a local Unix socket.
+
+    Every client connection starts with a JSON request frame. "exec" requests
+    are relayed as frames ("o" stdout, "e" stderr, "x" exit status one way and
+    "i" stdin, "f" end of stdin, "w" window size the other), while "sftp" requests splice the
+    raw subsystem bytes so the client can use paramiko.SFTPClient directly.
+    """
+
+    def __init__(self, server_info, auth_info, password, idle_timeout):
+        self.server_info = server_info
+        self.auth_info = auth_info
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self.ssh_client = None
+        self.lock = threading.Lock()
+        self.active = 0
+        self.last_used = time.monotonic()
+        self.running = True
+
+    def transport(self):
+        """Returns the held transport, reconnecting if it has dropped"""
+        with self.lock:
+            transport = self.ssh_client.get_transport() if self.ssh_client else None
+            if transport is None or not transport.is_active():
+                if self.ssh_client is not None:
+                    self.ssh_client.close()
+                self.ssh_client = open_ssh_client(
+                    self.server_info, self.auth_info, self.password
+                )
+                transport = self.ssh_client.get_transport()
+            return transport
+
+    def serve_forever(self, path, ready_fd):
+        """Connects, listens on path and serves clients until idle or stopped"""
+        try:
+            self.transport()
+            if os.path.exists(path):
+                os.unlink(path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(path)
+            os.chmod(path, 0o600)
+            bound_inode = os.stat(path).st_ino
+            listener.listen(16)
+        except (
+            paramiko.AuthenticationException,
+            paramiko.SSHException,
+            OSError,
+            ValueError,
+        ) as e:
+            os.write(ready_fd, str(e).encode() or b"connection failed")
+            os.close(ready_fd)
+            return
+        os.write(ready_fd, b"ok")
+        os.close(ready_fd)
+
+        listener.settimeout(1)
+        try:
+            while self.running:
+                try:
+                    conn, _ = listener.accept()
+                except socket.timeout:
+                    with self.lock:
+                        idle = time.monotonic() - self.last_used
+                        if self.active == 0 and idle > self.idle_timeout:
+                            break
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            # A newer daemon may have replaced the socket; only remove our own
+            try:
+                if os.stat(path).st_ino == bound_inode:
+                    os.unlink(path)
+            except OSError:
+                pass
+            if self.ssh_client is not None:
+                self.ssh_client.close()
+
+    def handle(self, conn):
+        """Serves a single client connection"""
+        with self.lock:
+            self.active += 1
+        try:
+            kind, payload = recv_frame(conn)
+            if kind != b"R":
+                return
+            request = json.loads(payload.decode())
+            if request["kind"] == "stop":
+                self.running = False
+                send_frame(conn, b"K")
+                return
+            try:
+                transport = self.transport()
+            except (
+                paramiko.AuthenticationException,
+                paramiko.SSHException,
+                OSError,
+            ) as e:
+                send_frame(conn, b"E", str(e).encode())
+                return
+
+            if request["kind"] == "ping":
+                identity = {
+                    "address": self.server_info["address"],
+                    "port": self.server_info.get("port", "22"),
+                    "username": self.server_info["username"],
+                    "pid": os.getpid(),
+                }
+                send_frame(conn, b"K", json.dumps(identity).encode())
+            elif request["kind"] == "sftp":
+                chan = transport.open_session()
+                chan.invoke_subsystem("sftp")
+                send_frame(conn, b"K")
+                self.splice(conn, chan)
+            elif request["kind"] == "exec":
+                chan = transport.open_session()
+                if request.get("pty"):
+                    width, height = request.get("size", (80, 24))
+                    chan.get_pty(
+                        term=request.get("term", "vt100"), width=width, height=height
+                    )
+                chan.exec_command(request["command"])
+                send_frame(conn, b"K")
+                self.relay_exec(conn, chan)
+        except (OSError, paramiko.SSHException, ValueError, KeyError):
+            pass
+        finally:
+            conn.close()
+            with self.lock:
+                self.active -= 1
+                self.last_used = time.monotonic()
+
+    @staticmethod
+    def splice(conn, chan):
+        """Copies raw bytes both ways between a client socket and a channel"""
+        sel = selectors.DefaultSelector()
+        sel.register(conn, selectors.EVENT_READ, "client")
+        sel.register(chan, selectors.EVENT_READ, "chan")
+        try:
+            while True:
+                for key, _ in sel.select():
+                    if key.data == "client":
+                        data = conn.recv(65536)
+                        if not data:
+                            return
+                        chan.sendall(data)
+                    else:
+                        data = chan.recv(65536)
+                        if not data:
+                            return
+                        conn.sendall(data)
+        finally:
+            sel.close()
+            chan.close()
+
+    @staticmethod
+    def relay_exec(conn, chan):
+        """Relays a command channel to a client socket as frames"""
+        sel = selectors.DefaultSelector()
+        sel.register(conn, selectors.EVENT_READ, "client")
+        sel.register(chan, selectors.EVENT_READ, "chan")
+        try:
+            while True:
+                for key, _ in sel.select(timeout=1):
+                    if key.data != "client":
+                        continue
+                    kind, payload = recv_frame(conn)
+                    if kind is None:
+                        return
+                    if kind == b"i":
+                        chan.sendall(payload)
+                    elif kind == b"f":
+                        chan.shutdown_write()
+                    elif kind == b"w":
+                        width, height = struct.unpack("!II", payload)
+                        chan.resize_pty(width=width, height=height)
+                while chan.recv_ready():
+                    send_frame(conn, b"o", chan.recv(65536))
+                while chan.recv_stderr_ready():
+                    send_frame(conn, b"e", chan.recv_stderr(65536))
+                if chan.exit_status_ready() and (chan.eof_received or chan.closed):
+                    if not chan.recv_ready() and not chan.recv_stderr_ready():
+                        status = chan.recv_exit_status()
+                        send_frame(conn, b"x", struct.pack("!i", status))
+                        return
+        finally:
+            sel.close()
+            chan.close()
+
+
+class DaemonSocket(socket.socket):
+    """Client socket to the zse daemon, also usable as an SFTP transport"""
+
+    def get_name(self):
+        """Names the session in paramiko's SFTP log messages"""
+        return "zse-daemon"
+
+
+class DaemonClient:
+    """Stands in for the parts of paramiko.SSHClient that zse uses, but opens
+    every channel through a running zse daemon instead of a new connection"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def request(self, **request):
+        """Sends a request to the daemon, returning the socket and its reply"""
+        sock = DaemonSocket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            send_frame(sock, b"R", json.dumps(request).encode())
+            kind, payload = recv_frame(sock)
+        except OSError:
+            sock.close()
+            raise
+        if kind != b"K":
+            sock.close()
+            raise paramiko.SSHException(
+                payload.decode(errors="replace") or "zse daemon error"
+            )
+        return sock, payload
+
+    def ping(self):
+        """Returns the identity of the running daemon, or None"""
+        try:
+            sock, reply = self.request(kind="ping")
+        except (OSError, paramiko.SSHException):
+            return None
+        sock.close()
+        return json.loads(reply.decode())
+
+    def matches(self, server_info):
+        """Checks that a daemon is running for the configured user and host"""
+        identity = self.ping()
+        if identity is None:
+            return False
+        return (
+            identity["address"] == server_info.get("address")
+            and identity["port"] == server_info.get("port", "22")
+            and identity["username"] == server_info.get("username")
+        )
+
+    def exec_command(self, command, get_pty=False):
+        """Runs a command through the daemon, mirroring SSHClient.exec_command"""
+        sock, _ = self.request(kind="exec", command=command, pty=get_pty)
+        chan = DaemonChannel(sock)
+        return (
+            DaemonStream(chan, "stdin"),
+            DaemonStream(chan, "stdout"),
+            DaemonStream(chan, "stderr"),
+        )
+
+    def open_terminal(self, command, term, width, height):
+        """Runs a command in a pty of the given size through the daemon,
+        returning its DaemonChannel"""
+        sock, _ = self.request(
+            kind="exec", command=command, pty=True, term=term, size=[width, height]
+        )
+        return DaemonChannel(sock)
+
+    def open_sftp(self):
+        """Opens an SFTP session spliced through the daemon"""
+        return paramiko.SFTPClient(self.request(kind="sftp")[0])
+
+    def close(self):
+        """The daemon keeps the connection open, so there is nothing to close"""
+
+
+class DaemonChannel:
+    """Client end of a command relayed by the zse daemon, exposing the subset
+    of paramiko.Channel that zse relies on"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffers = {"stdout": bytearray(), "stderr": bytearray()}
+        self.exit_status = None
+        self.eof = False
+        self.timeout = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.pipe = None
+        self.pipe_set = False
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def _reader(self):
+        while True:
+            try:
+                kind, payload = recv_frame(self.sock)
+            except OSError:
+                kind, payload = None, b""
+            with self.cond:
+                if kind == b"o":
+                    self.buffers["stdout"] += payload
+                elif kind == b"e":
+                    self.buffers["stderr"] += payload
+                elif kind == b"x":
+                    (self.exit_status,) = struct.unpack("!i", payload)
+                if kind in (None, b"x"):
+                    self.eof = True
+                    if self.exit_status is None:
+                        self.exit_status = -1
+                self._update_pipe()
+                self.cond.notify_all()
+            if self.eof:
+                return
+
+    def _recv(self, name, nbytes):
+        with self.cond:
+            if not self.cond.wait_for(
+                lambda: self.buffers[name] or self.eof, self.timeout
+            ):
+                raise socket.timeout()
+            data = bytes(self.buffers[name][:nbytes])
+            del self.buffers[name][:nbytes]
+            self._update_pipe()
+            return data
+
+    def _update_pipe(self):
+        if self.pipe is None:
+            return
+        ready = self.eof or any(self.buffers.values())
+        if ready and not self.pipe_set:
+            os.write(self.pipe[1], b"*")
+            self.pipe_set = True
+        elif not ready and self.pipe_set:
+            os.read(self.pipe[0], 1)
+            self.pipe_set = False
+
+    def fileno(self):
+        """Returns a descriptor that selects as readable while data is buffered"""
+        with self.cond:
+            if self.pipe is None:
+                self.pipe = os.pipe()
+                self._update_pipe()
+            return self.pipe[0]
+
+    def recv(self, nbytes):
+        """Reads up to nbytes of stdout, returning b"" once the command ends"""
+        return self._recv("stdout", nbytes)
+
+    def recv_stderr(self, nbytes):
+        """Reads up to nbytes of stderr, returning b"" once the command ends"""
+        return self._recv("stderr", nbytes)
+
+    def recv_ready(self):
+        """Checks if stdout data is buffered"""
+        return bool(self.buffers["stdout"])
+
+    def recv_stderr_ready(self):
+        """Checks if stderr data is buffered"""
+        return bool(self.buffers["stderr"])
+
+    def exit_status_ready(self):
+        """Checks if the command has finished"""
+        return self.exit_status is not None
+
+    def recv_exit_status(self):
+        """Waits for the command to finish and returns its exit status"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.exit_status is not None)
+            return self.exit_status
+
+    def settimeout(self, timeout):
+        """Sets the timeout used by recv"""
+        self.timeout = timeout
+
+    def send(self, data):
+        """Sends data to the command's stdin"""
+        if isinstance(data, str):
+            data = data.encode()
+        send_frame(self.sock, b"i", data)
+        return len(data)
+
+    def sendall(self, data):
+        """Sends all of data to the command's stdin"""
+        self.send(data)
+
+    def shutdown_write(self):
+        """Closes the command's stdin"""
+        send_frame(self.sock, b"f")
+
+    def resize_pty(self, width=80, height=24):
+        """Resizes the command's pty"""
+        send_frame(self.sock, b"w", struct.pack("!II", width, height))
+
+    def close(self):
+        """Closes the relayed channel"""
+        self.closed = True
+        self.sock.close()
+        if self.pipe is not None:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
+
+class DaemonStream:
+    """File-like stdin/stdout/stderr for a DaemonChannel"""
+
+    def __init__(self, channel, name):
+        self.channel = channel
+        self.name = name
+
+    def read(self):
+        """Reads until the command ends"""
+        data = bytearray()
+        while True:
+            if self.name == "stderr":
+                chunk = self.channel.recv_stderr(65536)
+            else:
+                chunk = self.channel.recv(65536)
+            if not chunk:
+                return bytes(data)
+            data += chunk
+
+    def write(self, data):
+        """Writes to the command's stdin"""
+        self.channel.sendall(data)
+
+    def close(self):
+        """Closes stdin"""
+        if self.name == "stdin":
+            self.channel.shutdown_write()
+
+
 def print_err_msg(errno):
     """Helper function that prints error messages"""
-    config_dir = str(user_config_dir("zse"))
+    config_dir = str(platformdirs.user_config_dir("zse"))
     if errno == Error.CONNECTION:
         sys.stderr.write(
-            f"{Fore.RED}"
+            f"{colorama.Fore.RED}"
             + "Error: Cannot connect to CSE server. Review config file @ "
             + f"{config_dir}."
-            + f"{Fore.RESET}\n"
+            + f"{colorama.Fore.RESET}\n"
         )
     elif errno == Error.AUTH:
         sys.stderr.write(
-            Fore.RED
+            colorama.Fore.RED
             + "Error: Reading authentication method failed."
-            + Fore.RESET
+            + colorama.Fore.RESET
             + "\n"
         )
     elif errno == Error.EMPTY:
         sys.stderr.write(
-            f"{Fore.RED}"
+            f"{colorama.Fore.RED}"
             + "Error: Reading config.ini failed. Review config file @ "
             + f"{config_dir}"
-            + f"{Fore.RESET}"
+            + f"{colorama.Fore.RESET}"
         )
-    elif Error.REMOVAL:
+    elif errno == Error.REMOVAL:
         sys.stderr.write(
-            f"{Fore.RED}"
+            f"{colorama.Fore.RED}"
             + "Error: Cannot delete remote directory. Please review file permissions."
-            + f"{Fore.RESET}"
+            + f"{colorama.Fore.RESET}"
+        )
+    elif errno == Error.LIMITS:
+        sys.stderr.write(
+            f"{colorama.Fore.RED}"
+            + "Error: Upload blocked by the [limits] in config.ini @ "
+            + f"{config_dir}. Use --no-guards to upload it anyway."
+            + f"{colorama.Fore.RESET}\n"
         )
     sys.exit(1)
 
@@ -598,6 +3271,9 @@ def create_status_printer():
     def _print_status(status_num, **kwargs):
         nonlocal counter
 
+        if status_num in STATUS_PHASES:
+            timings.mark(STATUS_PHASES[status_num])
+
         non_increment = {Status.OUTPUT, Status.END_OUTPUT, Status.EXIT_STAT}
 
         if status_num not in non_increment:
@@ -636,6 +3312,228 @@ def create_status_printer():
     return _print_status
 
 
+class Timings:
+    """Records when each phase of a run starts (on the monotonic clock) and
+    how much was transferred, for the --timings report"""
+
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        self.start = time.monotonic()
+        self.spans = []
+        self.phases = []
+        self.transfers = {}
+        self.lock = threading.Lock()
+
+    def mark(self, phase):
+        """Records that phase starts now, ending the previous one"""
+        with self.lock:
+            if not self.phases or self.phases[-1][0] != phase:
+                self.phases.append((phase, time.monotonic()))
+
+    def add_transfer(self, direction, nbytes, files=1):
+        """Adds a transferred file and its size to the totals for direction"""
+        with self.lock:
+            totals = self.transfers.setdefault(direction, [0, 0])
+            totals[0] += files
+            totals[1] += nbytes
+
+    @contextlib.contextmanager
+    def span(self, name, **details):
+        """Records the enclosed block as a trace span when --trace is on"""
+        if not self.tracing:
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            thread = threading.current_thread()
+            with self.lock:
+                self.spans.append((name, start, end, thread, details))
+
+    def write_trace(self, path):
+        """Writes the spans and phases in Chrome trace-event format"""
+        pid = os.getpid()
+
+        def micros(t):
+            return round((t - self.start) * 1e6)
+
+        events = []
+        with self.lock:
+            phases = list(self.phases)
+            spans = list(self.spans)
+        end = time.monotonic()
+        for i, (phase, start) in enumerate(phases):
+            finish = phases[i + 1][1] if i + 1 < len(phases) else end
+            events.append(
+                {
+                    "name": phase,
+                    "cat": "phase",
+                    "ph": "X",
+                    "ts": micros(start),
+                    "dur": micros(finish) - micros(start),
+                    "pid": pid,
+                    "tid": 0,
+                }
+            )
+        thread_names = {0: "phases"}
+        for name, start, finish, thread, details in spans:
+            thread_names[thread.ident] = thread.name
+            events.append(
+                {
+                    "name": name,
+                    "cat": "zse",
+                    "ph": "X",
+                    "ts": micros(start),
+                    "dur": micros(finish) - micros(start),
+                    "pid": pid,
+                    "tid": thread.ident,
+                    "args": {key: str(value) for key, value in details.items()},
+                }
+            )
+        for tid, name in thread_names.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+            )
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        """Returns the phase durations and transfer totals as a dict"""
+        end = time.monotonic()
+        with self.lock:
+            phases = list(self.phases)
+            transfers = {key: list(value) for key, value in self.transfers.items()}
+        durations = {}
+        for i, (phase, start) in enumerate(phases):
+            finish = phases[i + 1][1] if i + 1 < len(phases) else end
+            durations[phase] = durations.get(phase, 0) + finish - start
+        return {
+            "phases": [
+                {"phase": phase, "seconds": round(seconds, 6)}
+                for phase, seconds in durations.items()
+            ],
+            "total_seconds": round(end - self.start, 6),
+            "transfers": {
+                direction: {"files": files, "bytes": nbytes}
+                for direction, (files, nbytes) in transfers.items()
+            },
+        }
+
+    def report(self, table=True, json_path=None):
+        """Prints the summary as a table and/or writes it as JSON"""
+        summary = self.summary()
+        if json_path == "-":
+            print(json.dumps(summary, indent=2))
+        elif json_path:
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(summary, f, indent=2)
+        if not table:
+            return
+
+        print(f"\033[1;35m{'=' * 15} Timings {'=' * 14}\033[0m")
+        for phase in summary["phases"]:
+            print(f"{phase['phase']:<22}{phase['seconds'] * 1000:>12.0f} ms")
+        print(f"{'total':<22}{summary['total_seconds'] * 1000:>12.0f} ms")
+        for direction, totals in summary["transfers"].items():
+            print(
+                f"{direction:<22}{totals['files']:>6} files "
+                f"{format_size(totals['bytes']):>10}"
+            )
+
+
+class Progress:
+    """Single progress line for a transfer, fed by the SFTP callbacks of every
+    worker thread and redrawn at most every PROGRESS_INTERVAL seconds, so the
+    terminal is never written to once per file or per chunk"""
+
+    def __init__(self, label, files, total_bytes):
+        self.label = label
+        self.files = files
+        self.total_bytes = total_bytes
+        self.files_done = 0
+        self.bytes_done = 0
+        self.start = time.monotonic()
+        self.last_draw = 0.0
+        self.lock = threading.Lock()
+        self.enabled = sys.stdout.isatty() and files > 0
+
+    def callback(self):
+        """Returns a paramiko put/get callback for one file"""
+        sent = 0
+
+        def update(transferred, _total):
+            nonlocal sent
+            with self.lock:
+                self.bytes_done += transferred - sent
+                sent = transferred
+                self.draw()
+
+        return update
+
+    def file_done(self, nbytes=0):
+        """Counts a finished file, plus nbytes when no callback reported them"""
+        with self.lock:
+            self.files_done += 1
+            self.bytes_done += nbytes
+            self.draw()
+
+    def draw(self, force=False):
+        """Rewrites the progress line if it is due, the caller holds lock"""
+        now = time.monotonic()
+        if not self.enabled or (not force and now - self.last_draw < PROGRESS_INTERVAL):
+            return
+        self.last_draw = now
+        elapsed = now - self.start
+        rate = self.bytes_done / elapsed if elapsed > 0 else 0
+        line = (
+            f"{self.label} {self.files_done}/{self.files} files  "
+            f"{format_size(self.bytes_done)}/{format_size(self.total_bytes)}  "
+            f"{format_size(rate)}/s"
+        )
+        if 0 < rate and self.bytes_done < self.total_bytes:
+            line += f"  ETA {(self.total_bytes - self.bytes_done) / rate:.0f}s"
+        columns = shutil.get_terminal_size().columns
+        sys.stdout.write(f"\r\033[K{line[: columns - 1]}")
+        sys.stdout.flush()
+
+    def finish(self):
+        """Clears the progress line once the transfer is over"""
+        with self.lock:
+            if self.enabled and self.last_draw:
+                sys.stdout.write("\r\033[K")
+                sys.stdout.flush()
+            self.enabled = False
+
+
+def format_size(nbytes):
+    """Formats a byte count for humans"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if nbytes < 1024 or unit == "GB":
+            return f"{nbytes:.0f} {unit}" if unit == "B" else f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} GB"
+
+
+STATUS_PHASES = {
+    Status.CONNECTING: "connect",
+    Status.AUTHENTICATING: "remote setup",
+    Status.SFTP: "sftp open",
+    Status.SYNCING: "command",
+    Status.SENT: "command",
+    Status.END_OUTPUT: "finish",
+}
+
+timings = Timings()
+local_scan = LocalScan()
 print_status = create_status_printer()
 
 if __name__ == "__main__":
@@ -38,6 +38,9 @@ setup(
         "platformdirs",
         "setuptools",
     ],
+    extras_require={
+        "zstd": ["zstandard"],
+    },
     entry_points={
         "console_scripts": [
             "zse=main:main",